@@ -131,29 +131,19 @@ done
 echo "🔍 Проверка установки..."
 
 # Проверяем исполняемый файл
+# Проверки флага исполнения достаточно - запуск piper --help ничего не добавляет
 if [ -x "piper_tts/bin/piper/piper" ]; then
     echo "✅ Исполняемый файл Piper найден"
-    
-    # Тестируем работоспособность
-    if piper_tts/bin/piper/piper --help >/dev/null 2>&1; then
-        echo "✅ Piper исполняемый файл работает корректно"
-        
-        # Проверяем версию
-        if piper_tts/bin/piper/piper --version 2>/dev/null; then
-            echo "✅ Версия Piper получена"
-        fi
-    else
-        echo "⚠️ Предупреждение: Piper исполняемый файл может не работать"
-    fi
 else
     echo "⚠️ Исполняемый файл Piper не найден"
 fi
 
-# Подсчитываем финальное количество моделей
-FINAL_MODELS=$(find piper_tts/voices -name "*.onnx" 2>/dev/null | wc -l)
+# Один проход по директории и для подсчета, и для списка моделей
+MODEL_FILES=$(find piper_tts/voices -name "*.onnx" -printf '%f\n' 2>/dev/null | sort)
+FINAL_MODELS=$(printf '%s' "$MODEL_FILES" | grep -c .)
 echo "📋 Итоговое количество голосовых моделей: $FINAL_MODELS"
 
 echo "📝 Доступные модели:"
-find piper_tts/voices -name "*.onnx" -exec basename {} \; 2>/dev/null | sort
+[ -n "$MODEL_FILES" ] && echo "$MODEL_FILES"
 
 echo "🎉 Установка Piper TTS завершена!" 
\ No newline at end of file
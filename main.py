@@ -2,34 +2,42 @@ import os
 import logging
 import asyncio
 import base64
+import hashlib
 import re
-import tempfile
 import subprocess
-import json
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
-from typing import Dict, List, Optional
+import time
+import io
+from itertools import islice
+from types import MappingProxyType
+from datetime import date, datetime
+from functools import lru_cache
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Mapping, Optional
 import aiohttp
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
 from aiohttp import web
 from newsapi import NewsApiClient
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.error import RetryAfter
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 
 # Настройка логирования (должно быть в начале!)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.getenv('LOG_LEVEL', 'INFO').upper()
 )
 logger = logging.getLogger(__name__)
 
 # Проверка доступности функций
 try:
     from gtts import gTTS
-    import tempfile
     import speech_recognition as sr
     from pydub import AudioSegment
     
@@ -43,33 +51,320 @@ except ImportError as e:
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 AI_API_KEY = os.getenv('AI_API_KEY')
 NEWS_API_KEY = os.getenv('NEWS_API_KEY')
+AZURE_SPEECH_KEY = os.getenv('AZURE_SPEECH_KEY')
+AZURE_SPEECH_REGION = os.getenv('AZURE_SPEECH_REGION', 'eastus')
 GEMINI_API_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent'
+GEMINI_URL_WITH_KEY = f"{GEMINI_API_URL}?key={AI_API_KEY}"
+GEMINI_HEADERS = {'Content-Type': 'application/json'}
+AZURE_TTS_URL = f"https://{AZURE_SPEECH_REGION}.tts.speech.microsoft.com/cognitiveservices/v1"
+AZURE_TTS_HEADERS = {
+    'Ocp-Apim-Subscription-Key': AZURE_SPEECH_KEY or '',
+    'Content-Type': 'application/ssml+xml',
+    'X-Microsoft-OutputFormat': 'audio-24khz-48kbitrate-mono-mp3'
+}
+# Обертка SSML для Azure Speech: строгий формат без лишних атрибутов, пробелов и переносов строк,
+# с правильными пространствами имен - так корректно работают все голоса
+AZURE_SSML_PREFIX = (b'<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" '
+                     b'xmlns:mstts="https://www.w3.org/2001/mstts" xml:lang="ru-RU"><voice name="')
+AZURE_SSML_MIDDLE = b'">'
+AZURE_SSML_SUFFIX = b'</voice></speak>'
 PORT = int(os.getenv('PORT', 10000))
+DEBUG_WEBHOOK = os.getenv('DEBUG_WEBHOOK') == '1'  # Подробная диагностика входящих обновлений
 
 # Лимиты запросов
 MINUTE_LIMIT = 10
 DAILY_LIMIT = 250
 
+# Сообщения о превышении лимитов
+LIMIT_EXCEEDED_TEMPLATE = "⚠️ Превышен лимит запросов.\n🕐 Осталось в минуте: %d\n📅 Осталось сегодня: %d"
+VOICE_LIMIT_EXCEEDED_TEMPLATE = "❌ Превышен лимит запросов!\n\nОсталось запросов: %d/%d в этой минуте, %d/%d сегодня."
+
+# Тексты команд /start, /help и /limits (статические части собираются один раз)
+WELCOME_MESSAGE = """🤖 Добро пожаловать в Gemini Bot!
+
+Я могу помочь вам с:
+• 💬 Ответами на текстовые вопросы
+• 🖼️ Анализом изображений
+• 🌐 Поиском актуальной информации
+
+Команды:
+/start - Показать это сообщение
+/help - Справка
+/clear - Очистить историю чата
+/limits - Показать лимиты запросов
+
+Просто отправьте мне текст или изображение!"""
+VOICE_FEATURES_STATUS = "✅ доступны" if VOICE_FEATURES_AVAILABLE else "❌ недоступны"
+HELP_MESSAGE_TEMPLATE = f"""📋 Справка по командам:
+
+/start - Приветствие
+/help - Показать эту справку
+/clear - Очистить историю переписки
+/limits - Показать лимиты запросов
+/voice - Включить/отключить голосовые ответы
+/voice_select - Выбрать голосовой движок
+
+🔄 Как пользоваться:
+• 💬 Отправьте текстовое сообщение для получения ответа
+• 🎤 Отправьте голосовое сообщение - я распознаю речь и отвечу голосом
+• 🖼️ Отправьте изображение для анализа
+• 📰 Бот автоматически ищет актуальную информацию при необходимости
+
+🎵 Голосовые функции: {VOICE_FEATURES_STATUS}
+Голосовые ответы: %s
+Текущий голос: %s
+
+⚡ Лимиты: 10 запросов в минуту, 250 в день"""
+LIMITS_MESSAGE_TEMPLATE = (
+    "📊 *Информация о лимитах запросов*\n\n"
+    f"• Осталось в текущей минуте: %d/{MINUTE_LIMIT}\n"
+    f"• Осталось сегодня: %d/{DAILY_LIMIT}\n\n"
+    "_Лимиты нужны для защиты от перегрузки и обеспечения стабильной работы бота._"
+)
+
+# Статические тексты ответов
+AI_NO_RESPONSE_MESSAGE = (
+    "❌ Не удалось получить ответ от ИИ.\n\n"
+    "Попробуйте:\n"
+    "• Переформулировать вопрос\n"
+    "• Повторить запрос через несколько секунд\n"
+    "• Проверить соединение с интернетом"
+)
+SPEECH_NOT_RECOGNIZED_MESSAGE = (
+    "❌ Не удалось распознать речь.\n\n"
+    "Попробуйте:\n"
+    "• Говорить четче и громче\n"
+    "• Уменьшить фоновый шум\n"
+    "• Записать сообщение заново"
+)
+VOICE_UNAVAILABLE_MESSAGE = (
+    "🎤 Извините, голосовые функции недоступны.\n\n"
+    "Сервер не поддерживает обработку голосовых сообщений.\n"
+    "Пожалуйста, отправьте ваш вопрос текстом."
+)
+VOICE_ERROR_MESSAGE = "❌ Произошла ошибка при обработке голосового сообщения."
+
+# Промпт для запросов о возрасте
+AGE_PROMPT_TEMPLATE = """ВАЖНАЯ ИНФОРМАЦИЯ: Сегодня {date} ({year} год).
+
+Пользователь спрашивает: {query}
+
+При расчете возраста используй ТОЛЬКО текущий {year} год.
+Например, если человек родился в 1971 году, то в {year} году ему {example_age} лет.
+
+Отвечай точно и кратко, указывая текущий возраст на {year} год."""
+
+# Четырехзначный год в запросе о возрасте
+YEAR_PATTERN = re.compile(r'\b(?:1[89]|20)\d{2}\b')
+# Год, явно указанный как год рождения: "родился в 1971", "1971 года рождения"
+BIRTH_YEAR_PATTERN = re.compile(
+    r'(?:родил\w*|рожд[её]н\w*)\s+в\s+((?:1[89]|20)\d{2})\b'
+    r'|\b((?:1[89]|20)\d{2})\s*(?:г\.?|года)\s+рождения',
+    re.IGNORECASE
+)
+
+# Очистка текста для синтеза речи (шаблоны компилируются один раз, порядок важен)
+SPEECH_MARKDOWN_PATTERNS = (
+    (re.compile(r'\*\*(.*?)\*\*'), r'\1'),           # Жирный текст **текст**
+    (re.compile(r'\*(.*?)\*'), r'\1'),               # Курсив *текст*
+    (re.compile(r'__(.*?)__'), r'\1'),               # Подчеркивание __текст__
+    (re.compile(r'_(.*?)_'), r'\1'),                 # Курсив _текст_
+    (re.compile(r'```(.*?)```', re.DOTALL), r'\1'),  # Код ```текст```
+    (re.compile(r'`(.*?)`'), r'\1'),                 # Инлайн код `текст`
+    (re.compile(r'\[(.*?)\]\((.*?)\)'), r'\1'),       # Ссылки [текст](ссылка)
+)
+# Каждый шаблон разметки начинается с одного из этих символов
+SPEECH_MARKDOWN_CHARS_PATTERN = re.compile(r'[*_`\[]')
+SPEECH_SPECIAL_CHARS_PATTERN = re.compile(r'[^\w\s\.,;:!?«»\-–—()№]')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+# Граница предложений для разбивки длинного текста на части
+SENTENCE_SPLIT_PATTERN = re.compile(r'[.!?]+\s+')
+
+# Предложение вместе с завершающими знаками препинания (для потоковой разбивки текста)
+SENTENCE_PATTERN = re.compile(r'\S.*?(?:[.!?…]+(?=\s|$)|$)', re.DOTALL)
+
+# Более короткие голосовые сообщения не отправляем на распознавание
+MIN_SPEECH_DURATION_MS = 500
+# Более короткие части ответа не озвучиваются отдельно, а присоединяются к соседним
+MIN_SPEECH_CHUNK_CHARS = 10
+# Формат PCM для распознавания: 16 кГц, 16 бит, моно
+SPEECH_SAMPLE_RATE = 16000
+SPEECH_BYTES_PER_SECOND = SPEECH_SAMPLE_RATE * 2
+
+
+def compile_keywords(*keywords: str) -> re.Pattern:
+    """Одно регулярное выражение-альтернатива для поиска любой подстроки без учета регистра"""
+    return re.compile('|'.join(map(re.escape, keywords)), re.IGNORECASE)
+
+# Явные запросы актуальной информации
+CURRENT_DATA_PATTERN = compile_keywords(
+    'новости', 'свежие новости', 'последние новости',
+    'курс валют', 'курс доллара', 'курс евро', 'цена bitcoin',
+    'погода сегодня', 'погода сейчас', 'текущая погода',
+    'сколько лет', 'возраст', 'когда родился', 'когда родилась',
+    'какое число', 'какой день', 'какой месяц', 'какой год',
+    'текущая дата', 'текущее время', 'который час'
+)
+# Временные маркеры
+TIME_MARKER_PATTERN = compile_keywords(
+    'сегодня', 'сейчас', 'вчера', 'завтра', 'на данный момент',
+    'в настоящее время', 'текущий', 'актуальн', 'свеж', 'последн',
+    'число', 'дата', 'день недели', 'месяц', 'год'
+)
+# Вопросы об интересных фактах не требуют актуальных данных, даже с временными маркерами
+INTERESTING_FACT_PATTERN = re.compile(r'интересн.*факт|факт.*интересн', re.IGNORECASE | re.DOTALL)
+# Маршрутизация запросов актуальных данных по типу
+DATETIME_QUERY_PATTERN = compile_keywords(
+    'какое число', 'какой день', 'какой месяц', 'какой год',
+    'текущая дата', 'текущее время', 'который час',
+    'число', 'дата', 'день недели'
+)
+NEWS_QUERY_PATTERN = compile_keywords('новости', 'новость', 'политическ')
+CURRENCY_QUERY_PATTERN = compile_keywords('курс', 'цена', 'стоимость')
+WEATHER_QUERY_PATTERN = compile_keywords('погода')
+AGE_QUERY_PATTERN = compile_keywords('сколько лет', 'возраст', 'лет')
+# Первое число в запросе (например, количество новостей)
+NUMBER_PATTERN = re.compile(r'\d+')
+
+WEEKDAY_NAMES = ('понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье')
+MONTH_NAMES_GENITIVE = ('января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+                        'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря')
+
+
+@lru_cache(maxsize=1)
+def format_day(day: date) -> str:
+    """Дата в формате ДД.ММ.ГГГГ, форматируется один раз в сутки"""
+    return f"{day:%d.%m.%Y}"
+
+
+def today_str() -> str:
+    """Сегодняшняя дата в формате ДД.ММ.ГГГГ"""
+    return format_day(date.today())
+
+
+def years_word(n: int) -> str:
+    """Склонение слова "год" после числа: 1 год, 2 года, 5 лет"""
+    if n % 10 == 1 and n % 100 != 11:
+        return "год"
+    if 2 <= n % 10 <= 4 and not 12 <= n % 100 <= 14:
+        return "года"
+    return "лет"
+
+
+@lru_cache(maxsize=1)
+def get_daily_system_lines(day: date) -> tuple:
+    """Строки системного сообщения, которые меняются только раз в сутки"""
+    return (
+        f"Текущая дата: {day:%d.%m.%Y} ({day.year} год)",
+        f"День недели: {WEEKDAY_NAMES[day.weekday()]}",
+    )
+
+
+IMAGE_DESCRIPTION_PROMPT = "Опиши что ты видишь на этом изображении подробно."
+
+
+def build_image_request_body(image_data: bytes) -> bytes:
+    """Готовое JSON-тело запроса к Gemini для описания изображения (выполняется в пуле потоков)"""
+    return orjson.dumps({
+        "contents": [
+            {
+                "parts": [
+                    {"text": IMAGE_DESCRIPTION_PROMPT},
+                    {
+                        "inline_data": {
+                            "mime_type": "image/jpeg",
+                            "data": base64.b64encode(image_data).decode('ascii')
+                        }
+                    }
+                ]
+            }
+        ]
+    })
+
+
+class LRUDict(OrderedDict):
+    """Словарь со значением по умолчанию и ограниченным размером.
+
+    Обращение к записи делает её самой свежей, при переполнении
+    вытесняются записи, к которым дольше всего не обращались.
+    """
+
+    def __init__(self, default_factory, maxsize: int):
+        super().__init__()
+        self.default_factory = default_factory
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __missing__(self, key):
+        value = self[key] = self.default_factory()
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
 # Хранилище данных
-user_sessions: Dict[int, deque] = defaultdict(lambda: deque(maxlen=50))
-request_counts: Dict[int, Dict[str, List[datetime]]] = defaultdict(lambda: {'minute': [], 'day': []})
-voice_settings: Dict[int, bool] = defaultdict(lambda: True)  # По умолчанию голосовые ответы включены
+USER_CACHE_LIMIT = 10_000  # Сколько пользователей держать в памяти для истории и настроек
+# История - только тексты реплик: роль в запрос к Gemini не передается, поэтому не хранится
+user_sessions: Dict[int, deque] = LRUDict(lambda: deque(maxlen=50), USER_CACHE_LIMIT)
+# Token bucket на пользователя: [токены на минуту, токены на день, время последнего пополнения]
+request_buckets: Dict[int, List[float]] = LRUDict(lambda: [MINUTE_LIMIT, DAILY_LIMIT, time.monotonic()], USER_CACHE_LIMIT)
+user_last_seen: Dict[int, float] = {}  # user_id -> time.monotonic() последнего сообщения
+SESSION_IDLE_TIMEOUT = 3600  # История неактивных пользователей удаляется через час
+voice_settings: Dict[int, bool] = LRUDict(lambda: True, USER_CACHE_LIMIT)  # По умолчанию голосовые ответы включены
 
 # Голосовые настройки - будут инициализированы в initialize_voice_engines()
-voice_engine_settings: Dict[int, str] = defaultdict(str)  # Будет установлен позже
-VOICE_ENGINES: Dict[str, dict] = {}  # Будет заполнен в initialize_voice_engines()
+voice_engine_settings: Dict[int, str] = LRUDict(str, USER_CACHE_LIMIT)  # Будет установлен позже
+VOICE_ENGINES: Mapping[str, dict] = MappingProxyType({})  # Будет заполнен в initialize_voice_engines()
+DEFAULT_ENGINE_INFO: dict = {}  # Описание gTTS - запасной вариант для неизвестного движка
 DEFAULT_VOICE_ENGINE = "azure_dmitri"  # Будет установлен в initialize_voice_engines()
 
+# Команды выбора голоса: /voice_<name> и /voice<name> -> движок
+VOICE_COMMAND_ENGINES = {
+    "gtts": "gtts",
+    "dmitri": "azure_dmitri",
+    "svetlana": "azure_svetlana",
+}
+# Команды без учета регистра, как у CommandHandler: /Voice_Dmitri, /VOICEGTTS
+VOICE_COMMAND_PATTERN = re.compile(rf'^/voice_?({"|".join(VOICE_COMMAND_ENGINES)})(?:@\w+)?$', re.IGNORECASE)
+
+# Кэши ответов: одинаковые запросы в течение TTL не уходят во внешние сервисы
+GEMINI_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=120)  # история диалога -> ответ Gemini
+SEARCH_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=300)  # запрос -> результаты DuckDuckGo
+NEWS_CACHE: TTLCache = TTLCache(maxsize=64, ttl=60)  # количество новостей -> ответ NewsAPI
+CURRENCY_CACHE: TTLCache = TTLCache(maxsize=1, ttl=3600)  # курсы ЦБ публикуются раз в день
+currency_lock = asyncio.Lock()  # Одновременные промахи кэша курсов делают один запрос
+# Готовое аудио по (хэш текста, движок, язык); размер ограничен суммарным объемом в байтах
+TTS_CACHE: LRUCache = LRUCache(maxsize=32 * 1024 * 1024, getsizeof=len)
+TTS_PARALLEL_PARTS = 4  # Сколько частей одного ответа синтезируются одновременно
+# Выполняющиеся запросы к Gemini: одинаковая история -> общая задача
+gemini_inflight: Dict[tuple, asyncio.Task] = {}
+
 # Хранилище служебных сообщений для автоудаления
 user_service_messages: Dict[int, List[int]] = defaultdict(list)  # user_id -> [message_id, ...]
+pending_service_messages: Dict[int, asyncio.Task] = {}  # user_id -> последняя еще не отправленная замена служебного сообщения
+
+# Части длинных текстов, которые Telegram разрезал на несколько сообщений
+SPLIT_MESSAGE_THRESHOLD = 4000  # Сообщение такой длины, скорее всего, не последняя часть
+SPLIT_MESSAGE_WAIT = 2.0  # Сколько секунд ждать продолжения
+pending_text_parts: Dict[int, List[str]] = defaultdict(list)  # user_id -> накопленные части
+pending_text_flush: Dict[int, asyncio.Task] = {}  # user_id -> отложенная обработка частей
 
 # Хранилище обработанных сообщений для предотвращения дублирования
-processed_messages: Dict[str, bool] = {}  # message_id -> processed
+PROCESSED_MESSAGES_LIMIT = 1000  # Сколько последних message_id помнить
+processed_messages: "OrderedDict[str, None]" = OrderedDict()  # message_id -> None, от старых к новым
 
 def initialize_voice_engines():
     """Инициализация голосовых движков"""
-    global VOICE_ENGINES
-    VOICE_ENGINES = {
+    global VOICE_ENGINES, DEFAULT_ENGINE_INFO
+    # Таблица движков после инициализации только читается
+    VOICE_ENGINES = MappingProxyType({
         "gtts": {
             "name": "Google TTS",
             "description": "Стандартный качественный голос Google",
@@ -88,13 +383,14 @@ def initialize_voice_engines():
             "available": VOICE_FEATURES_AVAILABLE,
             "azure_voice": "ru-RU-SvetlanaNeural"
         }
-    }
+    })
+    DEFAULT_ENGINE_INFO = VOICE_ENGINES["gtts"]
     
     # Обновляем дефолтные настройки голоса для новых пользователей
     global voice_engine_settings, DEFAULT_VOICE_ENGINE
     default_engine = "azure_dmitri"  # Azure Дмитрий по умолчанию
     DEFAULT_VOICE_ENGINE = default_engine
-    voice_engine_settings = defaultdict(lambda: default_engine)
+    voice_engine_settings = LRUDict(lambda: default_engine, USER_CACHE_LIMIT)
     
     logger.info(f"Voice engines initialized.")
     logger.info(f"Default voice engine: {default_engine}")
@@ -106,62 +402,78 @@ def initialize_voice_engines():
 # Глобальная переменная для приложения
 telegram_app = None
 
+# Общая HTTP-сессия для всех исходящих запросов (создается при первом использовании)
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая HTTP-сессия с пулом соединений: TCP/TLS-соединения переиспользуются между запросами"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=30),
+            # Куки не нужны ни одному API, а общая сессия не должна переносить их между запросами пользователей
+            cookie_jar=aiohttp.DummyCookieJar()
+        )
+    return http_session
+
+# Отдельный HTTP/2-клиент для Gemini: параллельные запросы мультиплексируются в одном соединении
+gemini_client: Optional[httpx.AsyncClient] = None
+GEMINI_CONCURRENCY = 50  # Сколько запросов к Gemini может выполняться одновременно
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+def get_gemini_client() -> httpx.AsyncClient:
+    """Общий HTTP/2-клиент для запросов к Gemini API"""
+    global gemini_client
+    if gemini_client is None or gemini_client.is_closed:
+        gemini_client = httpx.AsyncClient(
+            http2=True,
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        )
+    return gemini_client
+
+async def close_http_session():
+    """Закрытие общих HTTP-клиентов при остановке бота"""
+    if http_session and not http_session.closed:
+        await http_session.close()
+    if gemini_client and not gemini_client.is_closed:
+        await gemini_client.aclose()
+
+# Фоновые задачи обработки webhook-обновлений (храним ссылки, чтобы их не собрал GC)
+webhook_tasks: set = set()
+# Долгоживущие фоновые задачи бота (keep-alive, очистка сессий, прогрев соединений)
+background_tasks: set = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    """Запуск фоновой задачи с сохранением ссылки на нее, чтобы ее не собрал GC"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 class GeminiBot:
     def __init__(self):
         # Инициализация NewsAPI если ключ есть
         self.news_client = NewsApiClient(api_key=NEWS_API_KEY) if NEWS_API_KEY else None
         logger.info(f"NewsAPI initialized: {'Yes' if self.news_client else 'No (missing API key)'}")
         
+        # Один распознаватель речи на все запросы: параметры не меняются между вызовами
+        self.recognizer = sr.Recognizer() if VOICE_FEATURES_AVAILABLE else None
+        
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /start"""
-        welcome_message = """🤖 Добро пожаловать в Gemini Bot!
-
-Я могу помочь вам с:
-• 💬 Ответами на текстовые вопросы
-• 🖼️ Анализом изображений
-• 🌐 Поиском актуальной информации
-
-Команды:
-/start - Показать это сообщение
-/help - Справка
-/clear - Очистить историю чата
-/limits - Показать лимиты запросов
-
-Просто отправьте мне текст или изображение!"""
-        
-        await update.message.reply_text(welcome_message)
+        await update.message.reply_text(WELCOME_MESSAGE)
         
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /help"""
         user_id = update.effective_user.id
         voice_status = "включены" if voice_settings[user_id] else "отключены"
-        voice_features_status = "✅ доступны" if VOICE_FEATURES_AVAILABLE else "❌ недоступны"
         
         current_engine = voice_engine_settings[user_id]
-        engine_info = VOICE_ENGINES.get(current_engine, VOICE_ENGINES["gtts"])
+        engine_info = VOICE_ENGINES.get(current_engine) or DEFAULT_ENGINE_INFO
         
-        help_message = f"""📋 Справка по командам:
-
-/start - Приветствие
-/help - Показать эту справку
-/clear - Очистить историю переписки
-/limits - Показать лимиты запросов
-/voice - Включить/отключить голосовые ответы
-/voice_select - Выбрать голосовой движок
-
-🔄 Как пользоваться:
-• 💬 Отправьте текстовое сообщение для получения ответа
-• 🎤 Отправьте голосовое сообщение - я распознаю речь и отвечу голосом
-• 🖼️ Отправьте изображение для анализа
-• 📰 Бот автоматически ищет актуальную информацию при необходимости
-
-🎵 Голосовые функции: {voice_features_status}
-Голосовые ответы: {voice_status}
-Текущий голос: {engine_info['name']}
-
-⚡ Лимиты: 10 запросов в минуту, 250 в день"""
-        
-        await update.message.reply_text(help_message)
+        await update.message.reply_text(HELP_MESSAGE_TEMPLATE % (voice_status, engine_info['name']))
         
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /clear"""
@@ -184,11 +496,11 @@ class GeminiBot:
     async def voice_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда /voice - переключение голосовых ответов"""
         user_id = update.effective_user.id
-        voice_settings[user_id] = not voice_settings[user_id]
+        enabled = voice_settings[user_id] = not voice_settings[user_id]
         
-        if voice_settings[user_id]:
+        if enabled:
             current_engine = voice_engine_settings[user_id]
-            engine_info = VOICE_ENGINES.get(current_engine, VOICE_ENGINES["gtts"])
+            engine_info = VOICE_ENGINES.get(current_engine) or DEFAULT_ENGINE_INFO
             status_message = f"🎵 Голосовые ответы включены!\n\nТекущий голос: {engine_info['name']}\n{engine_info['description']}\n\nИспользуйте /voice_select для выбора голоса."
         else:
             status_message = "📝 Голосовые ответы отключены.\n\nБот будет отвечать только текстом."
@@ -204,8 +516,8 @@ class GeminiBot:
         current_name = VOICE_ENGINES.get(current_engine, {}).get('name', 'Неизвестный')
         
         # Проверяем доступность Azure
-        azure_api_key = os.getenv('AZURE_SPEECH_KEY')
-        azure_status = "✅ Настроен" if azure_api_key else "❌ Не настроен"
+        azure_status = "✅ Настроен" if AZURE_SPEECH_KEY else "❌ Не настроен"
+        azure_warning = "" if AZURE_SPEECH_KEY else "\n\n⚠️ Azure движки требуют настройки API ключа AZURE_SPEECH_KEY"
         
         voice_list = f"""🎵 Доступные голосовые движки:
 
@@ -219,14 +531,11 @@ class GeminiBot:
 /voicesvetlana - Светлана (женский)
 
 ℹ️ Команды также работают с подчёркиваниями:
-/voice_gtts, /voice_dmitri и т.д."""
-
-        if not azure_api_key:
-            voice_list += "\n\n⚠️ Azure движки требуют настройки API ключа AZURE_SPEECH_KEY"
+/voice_gtts, /voice_dmitri и т.д.{azure_warning}"""
         
         await update.message.reply_text(voice_list)
 
-    async def set_voice_engine_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE, engine: str):
+    async def set_voice_engine_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE, *, engine: str):
         """Установка голосового движка"""
         user_id = update.effective_user.id
         
@@ -258,38 +567,42 @@ class GeminiBot:
             f"💡 Выбрать другой голос: /voice_select"
         )
 
+    async def voice_engine_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команды /voice_<name> и /voice<name> - выбор голоса по имени из команды"""
+        engine = VOICE_COMMAND_ENGINES[context.match.group(1).lower()]
+        await self.set_voice_engine_command(update, context, engine=engine)
+
     def clean_text_for_speech(self, text: str) -> str:
         """Очистка текста для синтеза речи"""
-        # Удаляем Markdown разметку
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # Жирный текст **текст**
-        text = re.sub(r'\*(.*?)\*', r'\1', text)      # Курсив *текст*
-        text = re.sub(r'__(.*?)__', r'\1', text)      # Подчеркивание __текст__
-        text = re.sub(r'_(.*?)_', r'\1', text)        # Курсив _текст_
-        text = re.sub(r'```(.*?)```', r'\1', text, flags=re.DOTALL)  # Код ```текст```
-        text = re.sub(r'`(.*?)`', r'\1', text)        # Инлайн код `текст`
-        text = re.sub(r'\[(.*?)\]\((.*?)\)', r'\1', text)  # Ссылки [текст](ссылка)
-        
-        # Удаляем лишние пробелы
-        text = re.sub(r'\s+', ' ', text)
+        # Удаляем Markdown разметку (один проход поиска вместо семи, если разметки нет)
+        if SPEECH_MARKDOWN_CHARS_PATTERN.search(text):
+            for pattern, replacement in SPEECH_MARKDOWN_PATTERNS:
+                text = pattern.sub(replacement, text)
         
         # Удаляем эмодзи и специальные символы, которые могут вызвать проблемы
-        text = re.sub(r'[^\w\s\.,;:!?«»\-–—()№]', ' ', text)
+        text = SPEECH_SPECIAL_CHARS_PATTERN.sub(' ', text)
         
         # Удаляем повторяющиеся пробелы
-        text = re.sub(r'\s+', ' ', text)
+        text = WHITESPACE_PATTERN.sub(' ', text)
         
         return text.strip()
 
-    def smart_split_text(self, text: str, max_chars: int = 200) -> List[str]:
-        """Умная разбивка текста на части для голосового синтеза"""
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def smart_split_text(text: str, max_chars: int = 200) -> tuple:
+        """Умная разбивка текста на части для голосового синтеза.
+
+        Результат зависит только от аргументов, поэтому кэшируется: повторная озвучка
+        того же ответа не разбирает текст заново. Возвращает неизменяемый кортеж.
+        """
         # Увеличиваем лимит до 200 символов для меньшего количества частей
         if len(text) <= max_chars:
-            return [text]
+            return (text,)
         
         parts = []
         
         # Сначала пробуем разбить по предложениям (точка, восклицательный, вопросительный знак)
-        sentences = re.split(r'[.!?]+\s+', text)
+        sentences = SENTENCE_SPLIT_PATTERN.split(text)
         current_part = ""
         
         for sentence in sentences:
@@ -368,102 +681,154 @@ class GeminiBot:
             for i in range(0, len(text), max_chars):
                 final_parts.append(text[i:i + max_chars])
         
-        return final_parts
+        return tuple(final_parts)
+
+    def iter_speech_chunks(self, text: str, max_chars: int = 200) -> Iterator[str]:
+        """Потоковая очистка и разбивка ответа на части для голосового синтеза.
+
+        Текст очищается по предложениям, а готовые части отдаются по мере накопления,
+        поэтому синтез первой части начинается до обработки всего ответа.
+        Части короче MIN_SPEECH_CHUNK_CHARS присоединяются к соседней (даже сверх
+        max_chars): слишком короткий текст синтез речи отклоняет.
+        """
+        pending = ""
+        for part in self._iter_raw_speech_chunks(text, max_chars):
+            if not pending:
+                pending = part
+            elif len(part) < MIN_SPEECH_CHUNK_CHARS or len(pending) < MIN_SPEECH_CHUNK_CHARS:
+                pending = f"{pending} {part}"
+            else:
+                yield pending
+                pending = part
 
-    def clean_old_requests(self, user_id: int):
-        """Очистка старых запросов"""
-        now = datetime.now()
-        minute_ago = now - timedelta(minutes=1)
-        day_ago = now - timedelta(days=1)
-        
-        # Очистка запросов старше минуты
-        request_counts[user_id]['minute'] = [
-            req_time for req_time in request_counts[user_id]['minute'] 
-            if req_time > minute_ago
-        ]
-        
-        # Очистка запросов старше дня
-        request_counts[user_id]['day'] = [
-            req_time for req_time in request_counts[user_id]['day'] 
-            if req_time > day_ago
-        ]
+        if pending:
+            yield pending
+
+    def _iter_raw_speech_chunks(self, text: str, max_chars: int) -> Iterator[str]:
+        """Части по предложениям не длиннее max_chars, без учета минимальной длины"""
+        current_part = ""
+
+        for match in SENTENCE_PATTERN.finditer(text):
+            sentence = self.clean_text_for_speech(match.group())
+            if not sentence:
+                continue
+
+            # Слишком длинное предложение разбиваем по запятым и словам
+            if len(sentence) > max_chars:
+                if current_part:
+                    yield current_part
+                pieces = self.smart_split_text(sentence, max_chars)
+                yield from pieces[:-1]
+                current_part = pieces[-1]
+                continue
+
+            candidate = f"{current_part} {sentence}" if current_part else sentence
+            if len(candidate) <= max_chars:
+                current_part = candidate
+            else:
+                yield current_part
+                current_part = sentence
+
+        if current_part:
+            yield current_part
+
+    def refill_request_bucket(self, user_id: int) -> List[float]:
+        """Пополнение token bucket пользователя пропорционально прошедшему времени"""
+        now = time.monotonic()
+        bucket = request_buckets[user_id]
+        elapsed = now - bucket[2]
+        bucket[0] = min(MINUTE_LIMIT, bucket[0] + elapsed * MINUTE_LIMIT / 60)
+        bucket[1] = min(DAILY_LIMIT, bucket[1] + elapsed * DAILY_LIMIT / 86400)
+        bucket[2] = now
+        return bucket
 
     def get_remaining_requests(self, user_id: int) -> tuple:
         """Получение оставшихся запросов"""
-        self.clean_old_requests(user_id)
-        
-        minute_requests = len(request_counts[user_id]['minute'])
-        day_requests = len(request_counts[user_id]['day'])
-        
-        remaining_minute = max(0, MINUTE_LIMIT - minute_requests)
-        remaining_day = max(0, DAILY_LIMIT - day_requests)
-        
-        return remaining_minute, remaining_day
+        bucket = self.refill_request_bucket(user_id)
+        return int(bucket[0]), int(bucket[1])
 
     def can_make_request(self, user_id: int) -> bool:
         """Проверка возможности сделать запрос"""
-        remaining_minute, remaining_day = self.get_remaining_requests(user_id)
-        return remaining_minute > 0 and remaining_day > 0
+        # Пополнение только добавляет токены: если их уже хватает, пересчет не нужен
+        bucket = request_buckets[user_id]
+        if bucket[0] >= 1 and bucket[1] >= 1:
+            return True
+        bucket = self.refill_request_bucket(user_id)
+        return bucket[0] >= 1 and bucket[1] >= 1
 
     def add_request(self, user_id: int):
         """Добавление запроса в счетчик"""
-        now = datetime.now()
-        request_counts[user_id]['minute'].append(now)
-        request_counts[user_id]['day'].append(now)
+        bucket = self.refill_request_bucket(user_id)
+        bucket[0] = max(0.0, bucket[0] - 1)
+        bucket[1] = max(0.0, bucket[1] - 1)
+
+    async def call_gemini_api(self, messages: Iterable[str]) -> Optional[str]:
+        """Вызов Gemini API
+
+        messages можно передавать напрямую из user_sessions: история читается
+        целиком до первой асинхронной операции, копия не нужна.
+        Ответы кэшируются по истории, кроме вопросов, зависящих от даты и времени,
+        а одинаковые одновременные запросы разделяют один HTTP-вызов.
+        """
+        messages = tuple(messages)
+        cacheable = bool(messages) and not (
+            CURRENT_DATA_PATTERN.search(messages[-1]) or TIME_MARKER_PATTERN.search(messages[-1])
+        )
+        if cacheable and messages in GEMINI_CACHE:
+            logger.debug("Gemini response served from cache")
+            return GEMINI_CACHE[messages]
+        
+        request = gemini_inflight.get(messages)
+        if request is None:
+            request = asyncio.create_task(self._request_gemini(messages))
+            gemini_inflight[messages] = request
+            request.add_done_callback(lambda _: gemini_inflight.pop(messages, None))
+        else:
+            logger.debug("Joining in-flight Gemini request")
+        
+        # shield: отмена одного ожидающего не должна прерывать запрос для остальных
+        text = await asyncio.shield(request)
+        if text is not None and cacheable:
+            GEMINI_CACHE[messages] = text
+        return text
 
-    async def call_gemini_api(self, messages: List[dict]) -> Optional[str]:
-        """Вызов Gemini API"""
+    async def _request_gemini(self, messages: tuple) -> Optional[str]:
+        """HTTP-запрос к Gemini API с историей сообщений"""
         try:
-            # Определяем контекст запроса
-            user_message = ""
-            if messages and len(messages) > 0:
-                user_message = messages[-1].get("content", "").lower()
-            
-            headers = {
-                'Content-Type': 'application/json',
-            }
-            
             # Всегда добавляем системное сообщение с текущей датой для контекста
-            all_messages = []
-            current_date = datetime.now().strftime("%d.%m.%Y")
-            current_year = datetime.now().year
-            current_time = datetime.now().strftime("%H:%M:%S")
+            now = datetime.now()
+            date_line, weekday_line = get_daily_system_lines(now.date())
             
             # Системное сообщение с актуальной информацией
             system_message = f"""СИСТЕМНАЯ ИНФОРМАЦИЯ:
-Текущая дата: {current_date} ({current_year} год)
-Текущее время: {current_time} (московское время)
-День недели: {['понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье'][datetime.now().weekday()]}
+{date_line}
+Текущее время: {now:%H:%M:%S} (московское время)
+{weekday_line}
 
 ВАЖНО: Всегда используй эту актуальную дату при ответах на вопросы о времени, датах, днях недели, возрасте и т.д."""
             
-            all_messages.append({"role": "system", "content": system_message})
-            all_messages.extend(messages)
-            
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {"text": msg["content"]} for msg in all_messages
-                        ]
-                    }
-                ]
-            }
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{GEMINI_API_URL}?key={AI_API_KEY}",
-                    headers=headers,
-                    json=data,
-                    timeout=30
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        if 'candidates' in result and len(result['candidates']) > 0:
-                            return result['candidates'][0]['content']['parts'][0]['text']
-                    else:
-                        logger.error(f"Gemini API error: {response.status}")
+            parts = [{"text": system_message}]
+            parts.extend({"text": message} for message in messages)
+            payload = orjson.dumps({"contents": [{"parts": parts}]})
+            
+            async with gemini_semaphore, get_gemini_client().stream(
+                "POST",
+                GEMINI_URL_WITH_KEY,
+                headers=GEMINI_HEADERS,
+                content=payload
+            ) as response:
+                if response.status_code == 200:
+                    raw = await response.aread()
+                    try:
+                        return orjson.loads(raw)['candidates'][0]['content']['parts'][0]['text']
+                    except (KeyError, IndexError, TypeError):
+                        logger.error(f"Unexpected Gemini API response: {raw[:200]!r}")
                         return None
+                else:
+                    # Для лога достаточно начала тела ошибки, остальное не читаем
+                    error_body = await anext(response.aiter_bytes(4096), b"")
+                    logger.error(f"Gemini API error: {response.status_code} {error_body[:200]!r}")
+                    return None
                         
         except Exception as e:
             logger.error(f"Error calling Gemini API: {e}")
@@ -475,95 +840,108 @@ class GeminiBot:
             return None
             
         try:
-            # Создаем временные файлы
-            with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as ogg_file:
-                ogg_file.write(audio_bytes)
-                ogg_path = ogg_file.name
-            
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as wav_file:
-                wav_path = wav_file.name
+            pcm = await self.decode_voice_to_pcm(audio_bytes)
+            if pcm is None:
+                return None
+            duration_ms = len(pcm) * 1000 // SPEECH_BYTES_PER_SECOND
+            if duration_ms < MIN_SPEECH_DURATION_MS:
+                logger.warning(f"Voice message too short for recognition: {duration_ms} ms")
+                return None
             
-            try:
-                # Конвертация OGG в WAV с помощью pydub
-                logger.debug("Converting OGG to WAV...")
-                audio = AudioSegment.from_ogg(ogg_path)
-                audio = audio.set_frame_rate(16000).set_channels(1)  # Оптимизация для распознавания
-                audio.export(wav_path, format="wav")
-                
-                # Распознавание речи
-                logger.debug("Recognizing speech...")
-                recognizer = sr.Recognizer()
-                
-                with sr.AudioFile(wav_path) as source:
-                    audio_data = recognizer.record(source)
-                
-                # Пробуем сначала русский, потом английский
-                try:
-                    text = recognizer.recognize_google(audio_data, language="ru-RU")
-                    logger.info(f"Speech recognized (Russian): {len(text)} characters")
-                    return text
-                except sr.UnknownValueError:
-                    # Если русский не сработал, пробуем английский
-                    try:
-                        text = recognizer.recognize_google(audio_data, language="en-US")
-                        logger.info(f"Speech recognized (English): {len(text)} characters")
-                        return text
-                    except sr.UnknownValueError:
-                        logger.warning("Could not understand audio in both Russian and English")
-                        return None
-                        
-            finally:
-                # Очистка временных файлов
-                try:
-                    os.unlink(ogg_path)
-                    os.unlink(wav_path)
-                except:
-                    pass
-                    
+            # Распознавание (HTTP к Google) блокирующее - выполняем в пуле потоков
+            return await asyncio.to_thread(self._speech_to_text_sync, pcm)
         except Exception as e:
             logger.error(f"Error in speech recognition: {e}")
             return None
 
-    async def text_to_speech(self, text: str, user_id: int, language: str = "ru") -> Optional[bytes]:
-        """Синтез речи из текста с поддержкой Google TTS и Azure Speech Services"""
+    async def decode_voice_to_pcm(self, audio_bytes: bytes) -> Optional[bytes]:
+        """Декодирование OGG в 16 кГц 16-бит моно PCM одним процессом ffmpeg через pipe,
+        без временных файлов, ffprobe и передискретизации в Python"""
+        logger.debug("Decoding OGG to PCM...")
+        process = await asyncio.create_subprocess_exec(
+            AudioSegment.converter, '-loglevel', 'error',
+            '-f', 'ogg', '-i', 'pipe:0',
+            '-f', 's16le', '-ar', str(SPEECH_SAMPLE_RATE), '-ac', '1', 'pipe:1',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            pcm, error = await process.communicate(audio_bytes)
+        except BaseException:
+            # Отмена обработчика или ошибка канала: не оставляем ffmpeg работать без присмотра
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            logger.error(f"ffmpeg decoding failed ({process.returncode}): {error.decode(errors='replace').strip()}")
+            return None
+        return pcm
+
+    def _speech_to_text_sync(self, pcm: bytes) -> Optional[str]:
+        """Синхронное распознавание речи из PCM через Google"""
+        logger.debug("Recognizing speech...")
+        recognizer = self.recognizer
+        audio_data = sr.AudioData(pcm, SPEECH_SAMPLE_RATE, 2)
+        
+        # Пробуем сначала русский, потом английский
+        try:
+            text = recognizer.recognize_google(audio_data, language="ru-RU")
+            logger.info(f"Speech recognized (Russian): {len(text)} characters")
+            return text
+        except sr.UnknownValueError:
+            # Если русский не сработал, пробуем английский
+            try:
+                text = recognizer.recognize_google(audio_data, language="en-US")
+                logger.info(f"Speech recognized (English): {len(text)} characters")
+                return text
+            except sr.UnknownValueError:
+                logger.warning("Could not understand audio in both Russian and English")
+                return None
+
+    async def text_to_speech(self, text: str, user_id: int, language: str = "ru", *, allow_fallback: bool = True) -> Optional[bytes]:
+        """Синтез речи выбранным пользователем движком с кэшем готового аудио.
+
+        С allow_fallback=False ошибка Azure не подменяется синтезом gTTS, чтобы
+        части одного ответа не оказались озвучены разными движками.
+        """
         if not VOICE_FEATURES_AVAILABLE:
             return None
-            
+        
+        engine = voice_engine_settings.get(user_id, DEFAULT_VOICE_ENGINE)
+        key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), engine, language)
+        audio = TTS_CACHE.get(key)
+        if audio is None:
+            audio = await self.synthesize_speech(text, engine, language, allow_fallback=allow_fallback)
+            if audio:
+                TTS_CACHE[key] = audio
+        else:
+            logger.debug(f"TTS served from cache: {len(audio)} bytes")
+        return audio
+
+    async def synthesize_speech(self, text: str, engine: str, language: str = "ru", *, allow_fallback: bool = True) -> Optional[bytes]:
+        """Синтез речи из текста с поддержкой Google TTS и Azure Speech Services"""
         try:
             # Проверка на минимальную длину текста
             if not text or len(text.strip()) < 3:
                 logger.warning("Text too short for TTS")
                 return None
                 
-            # Синтезируем полностью весь текст
-            logger.info(f"Synthesizing text of {len(text)} characters")
-            
-            # Получаем выбранный пользователем движок
-            engine = voice_engine_settings.get(user_id, DEFAULT_VOICE_ENGINE)
-            logger.info(f"User {user_id} selected engine: {engine}")
-            logger.debug(f"Converting text to speech with {engine}: {len(text)} characters")
-            
-            # Проверяем доступность движка
             engine_info = VOICE_ENGINES.get(engine)
-            if engine_info:
-                logger.info(f"Engine info for {engine}: name='{engine_info['name']}', available={engine_info['available']}")
-            else:
-                logger.warning(f"No engine info found for {engine}")
-            
+            logger.debug(f"Converting text to speech with {engine}: {len(text)} characters")
+
             if engine == "gtts":
-                logger.info("Using Google TTS")
                 return await self._gtts_synthesize(text, language)
             elif engine.startswith("azure_"):
-                logger.info(f"Using Azure Speech Services with engine: {engine}")
                 # Azure Speech Services TTS
-                engine_info = VOICE_ENGINES.get(engine)
                 if engine_info and "azure_voice" in engine_info:
                     azure_voice = engine_info["azure_voice"]
-                    logger.info(f"Using Azure voice: {azure_voice}")
-                    
+
                     # Проверяем API ключ Azure
-                    azure_api_key = os.getenv('AZURE_SPEECH_KEY')
-                    if not azure_api_key:
+                    if not AZURE_SPEECH_KEY:
                         logger.warning("Azure Speech API key not configured, falling back to Google TTS")
                         return await self._gtts_synthesize(text, language)
                     
@@ -571,6 +949,9 @@ class GeminiBot:
                     azure_result = await self._azure_synthesize(text, azure_voice)
                     if azure_result:
                         return azure_result
+                    elif not allow_fallback:
+                        logger.warning(f"Azure synthesis failed for {engine}")
+                        return None
                     else:
                         # Fallback к gTTS при ошибке Azure
                         logger.warning(f"Azure synthesis failed for {engine}, falling back to gTTS")
@@ -587,6 +968,8 @@ class GeminiBot:
                     
         except Exception as e:
             logger.error(f"Error in text-to-speech: {e}")
+            if not allow_fallback and engine != "gtts":
+                return None
             # В случае любой ошибки, пытаемся gTTS
             try:
                 logger.info("Attempting fallback to gTTS due to error")
@@ -594,93 +977,127 @@ class GeminiBot:
             except:
                 return None
 
+    async def text_to_speech_stream(self, text: str, user_id: int, language: str = "ru") -> AsyncIterator[Optional[bytes]]:
+        """Потоковый синтез речи: одна аудиозапись на каждую часть текста.
+
+        До TTS_PARALLEL_PARTS частей синтезируются одновременно, а отдаются строго
+        по порядку, поэтому их можно склеить в один файл. Все части озвучиваются
+        выбранным движком без подмены на gTTS; неудачная часть повторяется один раз,
+        а если и повтор не удался, отдаётся как None.
+        """
+        async def synthesize(part: str) -> Optional[bytes]:
+            audio = await self.text_to_speech(part, user_id, language, allow_fallback=False)
+            if audio is None:
+                logger.info("Retrying voice part synthesis for user %s", user_id)
+                audio = await self.text_to_speech(part, user_id, language, allow_fallback=False)
+            return audio
+
+        pending: deque = deque()
+        try:
+            for part in self.iter_speech_chunks(text):
+                pending.append(asyncio.create_task(synthesize(part)))
+                if len(pending) >= TTS_PARALLEL_PARTS:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # Генератор закрыт досрочно - незачем синтезировать оставшиеся части
+            for task in pending:
+                task.cancel()
+
     async def _gtts_synthesize(self, text: str, language: str) -> Optional[bytes]:
         """Оптимизированный синтез с помощью Google TTS"""
         try:
-            # Создание временного файла для аудио
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_file:
-                temp_path = temp_file.name
-            
-            try:
-                # Создание TTS объекта с оптимизацией скорости
-                # slow=False делает речь быстрее
-                tts = gTTS(text=text, lang=language, slow=False)
-                
-                # Сохранение в временный файл
-                tts.save(temp_path)
-                
-                # Чтение байтов из файла
-                with open(temp_path, 'rb') as audio_file:
-                    audio_bytes = audio_file.read()
-                
-                logger.info(f"gTTS synthesis success: generated {len(audio_bytes)} bytes")
-                return audio_bytes
-                
-            finally:
-                # Очистка временного файла
-                try:
-                    os.unlink(temp_path)
-                except:
-                    pass
+            # gTTS делает блокирующие HTTP-запросы - выполняем в пуле потоков
+            audio_bytes = await asyncio.to_thread(self._gtts_synthesize_sync, text, language)
+            logger.info(f"gTTS synthesis success: generated {len(audio_bytes)} bytes")
+            return audio_bytes
                     
         except Exception as e:
             logger.error(f"Error in gTTS synthesis: {e}")
             return None
 
+    def _gtts_synthesize_sync(self, text: str, language: str) -> bytes:
+        """Синхронный синтез Google TTS сразу в память, без временного файла"""
+        # Создание TTS объекта с оптимизацией скорости
+        # slow=False делает речь быстрее
+        tts = gTTS(text=text, lang=language, slow=False)
+        
+        audio_buffer = BytesIO()
+        tts.write_to_fp(audio_buffer)
+        return audio_buffer.getvalue()
+
     async def _azure_synthesize(self, text: str, voice: str = "ru-RU-SvetlanaNeural") -> Optional[bytes]:
         """Синтез с помощью Azure Speech Services"""
         try:
             # Проверяем наличие API ключа Azure
-            azure_api_key = os.getenv('AZURE_SPEECH_KEY')
-            azure_region = os.getenv('AZURE_SPEECH_REGION', 'eastus')
-            
-            if not azure_api_key:
+            if not AZURE_SPEECH_KEY:
                 logger.error("Azure Speech API key not found")
                 return None
             
-            # Определяем пол голоса по конкретному имени голоса
-            # Для русских голосов Azure
-            male_voices = ["ru-RU-DmitryNeural", "ru-RU-ArtemNeural"]
-            female_voices = ["ru-RU-SvetlanaNeural", "ru-RU-DaryaNeural", "ru-RU-PolinaNeural"]
-            
-            gender = 'Male' if voice in male_voices else 'Female'
-            logger.info(f"Using Azure voice {voice} with gender {gender}")
-            
-            # Создаем стандартный SSML для Azure Speech
-            # ВАЖНО: Используем строгий формат SSML без лишних атрибутов и с правильными пространствами имен
-            # Для корректной работы всех голосов (Дмитрий, Артём, Светлана, Дарья, Полина)
-            # Используем строгий формат без лишних пробелов и переносов строк
-            ssml = f'<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xmlns:mstts="https://www.w3.org/2001/mstts" xml:lang="ru-RU"><voice name="{voice}">{text}</voice></speak>'
-            
-            headers = {
-                'Ocp-Apim-Subscription-Key': azure_api_key,
-                'Content-Type': 'application/ssml+xml',
-                'X-Microsoft-OutputFormat': 'audio-24khz-48kbitrate-mono-mp3'
-            }
-            
-            url = f"https://{azure_region}.tts.speech.microsoft.com/cognitiveservices/v1"
+            logger.debug(f"Using Azure voice {voice}")
+
+            # SSML собирается из готовых байтовых частей: кодируется только имя голоса и текст
+            ssml = b''.join((AZURE_SSML_PREFIX, voice.encode(), AZURE_SSML_MIDDLE, text.encode('utf-8'), AZURE_SSML_SUFFIX))
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, data=ssml.encode('utf-8'), timeout=30) as response:
-                    if response.status == 200:
-                        audio_data = await response.read()
-                        logger.info(f"✅ Azure Speech synthesis successful: {len(audio_data)} bytes")
-                        return audio_data
-                    else:
-                        logger.error(f"Azure Speech API error: {response.status}")
-                        error_text = await response.text()
-                        logger.error(f"Error details: {error_text}")
-                        return None
+            session = get_http_session()
+            async with session.post(AZURE_TTS_URL, headers=AZURE_TTS_HEADERS, data=ssml, timeout=30) as response:
+                if response.status == 200:
+                    audio_data = await response.read()
+                    logger.info(f"✅ Azure Speech synthesis successful: {len(audio_data)} bytes")
+                    return audio_data
+                else:
+                    logger.error(f"Azure Speech API error: {response.status}")
+                    error_text = await response.text()
+                    logger.error(f"Error details: {error_text}")
+                    return None
         
         except Exception as e:
             logger.error(f"Error in Azure Speech synthesis: {e}")
             return None
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка текстовых сообщений"""
+        """Обработка текстовых сообщений
+
+        Telegram режет длинный текст на сообщения по 4096 символов. Почти полное
+        сообщение считается частью такого текста: его части копятся и уходят
+        в Gemini одним запросом. Обычные сообщения обрабатываются без задержки.
+        """
+        user_id = update.message.from_user.id
+        text = update.message.text
+        
+        flush = pending_text_flush.pop(user_id, None)
+        if flush:
+            flush.cancel()
+        
+        if len(text) >= SPLIT_MESSAGE_THRESHOLD:
+            # Ждем продолжения длинного сообщения
+            pending_text_parts[user_id].append(text)
+            pending_text_flush[user_id] = asyncio.create_task(
+                self.flush_text_parts(update, context, user_id, SPLIT_MESSAGE_WAIT)
+            )
+            return
+        
+        parts = pending_text_parts.pop(user_id, None)
+        if parts:
+            # Последняя часть длинного сообщения - обрабатываем все части вместе
+            parts.append(text)
+            text = "\n".join(parts)
+        
+        await self.process_text_message(update, context, text)
+
+    async def flush_text_parts(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, delay: float):
+        """Обработка накопленных частей, если продолжение так и не пришло"""
+        await asyncio.sleep(delay)
+        pending_text_flush.pop(user_id, None)
+        parts = pending_text_parts.pop(user_id, None)
+        if parts:
+            await self.process_text_message(update, context, "\n".join(parts))
+
+    async def process_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
+        """Ответ на текст пользователя"""
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
         
-        user_message = update.message.text
         user_id = update.message.from_user.id
         
         logger.info(f"Message from user {user_id}: {user_message[:50]}...")
@@ -688,11 +1105,7 @@ class GeminiBot:
         # Проверка лимитов
         if not self.can_make_request(user_id):
             remaining_minute, remaining_day = self.get_remaining_requests(user_id)
-            await update.message.reply_text(
-                f"⚠️ Превышен лимит запросов.\n"
-                f"🕐 Осталось в минуте: {remaining_minute}\n"
-                f"📅 Осталось сегодня: {remaining_day}"
-            )
+            await update.message.reply_text(LIMIT_EXCEEDED_TEMPLATE % (remaining_minute, remaining_day))
             return
         
         # Отправляем служебное сообщение о том, что думаем
@@ -703,10 +1116,7 @@ class GeminiBot:
         if needs_current:
             logger.info(f"User {user_id} needs current data for: {user_message}")
             
-            # Удаляем предыдущее служебное сообщение
-            await self.cleanup_service_messages(update, context, user_id)
-            
-            # Отправляем новое служебное сообщение
+            # Заменяем текст служебного сообщения
             await self.send_service_message(update, context, "🔍 Ищу актуальную информацию...", user_id)
             
             # Получаем актуальные данные
@@ -717,11 +1127,11 @@ class GeminiBot:
                 user_message = f"{user_message}\n\nАктуальная информация: {current_data}"
         
         # Добавление сообщения пользователя в историю
-        user_sessions[user_id].append({"role": "user", "content": user_message})
-        messages = list(user_sessions[user_id])
+        user_sessions[user_id].append(user_message)
+        user_last_seen[user_id] = time.monotonic()
         
         # Вызов API
-        response = await self.call_gemini_api(messages)
+        response = await self.call_gemini_api(user_sessions[user_id])
         
         if response:
             logger.info(f"Received response from Gemini API for user {user_id}: {len(response)} characters")
@@ -736,74 +1146,40 @@ class GeminiBot:
             await self.safe_send_message(update, response)
             
             # Добавление ответа в историю
-            user_sessions[user_id].append({"role": "assistant", "content": response})
+            user_sessions[user_id].append(response)
             
             logger.info(f"Successfully sent response to user {user_id}: {len(response)} characters")
         else:
             # Fallback ответ если API не ответил
             await self.cleanup_service_messages(update, context, user_id)
-            await update.message.reply_text(
-                "❌ Не удалось получить ответ от ИИ.\n\n"
-                "Попробуйте:\n"
-                "• Переформулировать вопрос\n"
-                "• Повторить запрос через несколько секунд\n"
-                "• Проверить соединение с интернетом"
-            )
+            await update.message.reply_text(AI_NO_RESPONSE_MESSAGE)
 
     def needs_current_data(self, query: str) -> bool:
         """Проверка, нужны ли актуальные данные"""
-        query_lower = query.lower()
-        
-        # Явные запросы актуальной информации
-        current_keywords = [
-            'новости', 'свежие новости', 'последние новости',
-            'курс валют', 'курс доллара', 'курс евро', 'цена bitcoin',
-            'погода сегодня', 'погода сейчас', 'текущая погода',
-            'сколько лет', 'возраст', 'когда родился', 'когда родилась',
-            'какое число', 'какой день', 'какой месяц', 'какой год',
-            'текущая дата', 'текущее время', 'который час'
-        ]
-        
-        # Временные маркеры
-        time_keywords = [
-            'сегодня', 'сейчас', 'вчера', 'завтра', 'на данный момент',
-            'в настоящее время', 'текущий', 'актуальн', 'свеж', 'последн',
-            'число', 'дата', 'день недели', 'месяц', 'год'
-        ]
-        
         # Проверяем явные запросы актуальной информации
-        if any(keyword in query_lower for keyword in current_keywords):
+        if CURRENT_DATA_PATTERN.search(query):
             return True
             
         # Проверяем комбинацию временных маркеров с определенными темами
-        has_time_marker = any(keyword in query_lower for keyword in time_keywords)
-        
-        if has_time_marker:
-            # Исключаем вопросы об интересных фактах
-            if 'интересн' in query_lower and 'факт' in query_lower:
-                return False
-            # Включаем другие запросы с временными маркерами
-            return True
+        if TIME_MARKER_PATTERN.search(query):
+            # Исключаем вопросы об интересных фактах, остальные запросы с временными маркерами включаем
+            return not INTERESTING_FACT_PATTERN.search(query)
             
         return False
 
     async def get_current_data(self, query: str) -> Optional[str]:
         """Получение актуальных данных"""
         try:
-            query_lower = query.lower()
-            
             # Определяем тип запроса
-            if any(word in query_lower for word in ['какое число', 'какой день', 'какой месяц', 'какой год', 
-                                                    'текущая дата', 'текущее время', 'который час',
-                                                    'число', 'дата', 'день недели']):
+            if DATETIME_QUERY_PATTERN.search(query):
                 return await self.get_current_datetime(query)
-            elif any(word in query_lower for word in ['новости', 'новость', 'политическ']):
+            elif NEWS_QUERY_PATTERN.search(query):
                 return await self.search_news(query)
-            elif any(word in query_lower for word in ['курс', 'цена', 'стоимость']):
+            elif CURRENCY_QUERY_PATTERN.search(query):
                 return await self.search_currency_rates(query)
-            elif any(word in query_lower for word in ['погода']):
+            elif WEATHER_QUERY_PATTERN.search(query):
                 return await self.search_weather_data(query)
-            elif any(word in query_lower for word in ['сколько лет', 'возраст', 'лет']):
+            elif AGE_QUERY_PATTERN.search(query):
                 return await self.handle_age_query(query)
             else:
                 # Общий поиск
@@ -818,32 +1194,31 @@ class GeminiBot:
         try:
             if self.news_client:
                 # Определяем количество новостей из запроса
-                numbers = re.findall(r'\d+', query)
-                count = int(numbers[0]) if numbers else 10
+                number = NUMBER_PATTERN.search(query)
+                count = int(number.group()) if number else 10
                 count = min(count, 50)  # Максимум 50 новостей
                 
-                articles = self.news_client.get_everything(
-                    q='россия OR политика OR путин OR правительство',
-                    language='ru',
-                    sort_by='publishedAt',
-                    page_size=count
-                )
+                # Запрос к NewsAPI фиксированный, поэтому ответ кэшируется по количеству новостей
+                articles = NEWS_CACHE.get(count)
+                if articles is None:
+                    # NewsApiClient синхронный (requests) - выполняем в потоке, чтобы не блокировать event loop
+                    articles = NEWS_CACHE[count] = await asyncio.to_thread(
+                        self.news_client.get_everything,
+                        q='россия OR политика OR путин OR правительство',
+                        language='ru',
+                        sort_by='publishedAt',
+                        page_size=count
+                    )
                 
                 if articles['articles']:
-                    news_list = []
-                    for i, article in enumerate(articles['articles'][:count], 1):
-                        title = article['title']
-                        description = article.get('description', '')
-                        url = article['url']
-                        
-                        news_item = f"{i}. {title}"
-                        if description:
-                            news_item += f"\n{description[:100]}..."
-                        news_item += f"\n🔗 {url}\n"
-                        
-                        news_list.append(news_item)
-                    
-                    return f"📰 ПОСЛЕДНИЕ НОВОСТИ ({count} шт.):\n\n" + "\n".join(news_list)
+                    # Каждая новость собирается одной f-строкой, ответ - одним join
+                    news_items = "\n".join(
+                        f"{i}. {article['title']}"
+                        + (f"\n{article['description'][:100]}..." if article.get('description') else "")
+                        + f"\n🔗 {article['url']}\n"
+                        for i, article in enumerate(islice(articles['articles'], count), 1)
+                    )
+                    return f"📰 ПОСЛЕДНИЕ НОВОСТИ ({count} шт.):\n\n{news_items}"
             
             # Fallback к поиску в интернете
             return await self.search_duckduckgo(query)
@@ -854,37 +1229,43 @@ class GeminiBot:
 
     async def search_duckduckgo(self, query: str) -> Optional[str]:
         """Поиск в DuckDuckGo"""
+        if query in SEARCH_CACHE:
+            return SEARCH_CACHE[query]
+        
         try:
             from urllib.parse import quote
             search_query = quote(query)
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"https://html.duckduckgo.com/html/?q={search_query}",
-                    headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'},
-                    timeout=15
-                ) as response:
-                    if response.status == 200:
-                        html = await response.text()
-                        soup = BeautifulSoup(html, 'html.parser')
+            session = get_http_session()
+            async with session.get(
+                f"https://html.duckduckgo.com/html/?q={search_query}",
+                headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'},
+                timeout=15
+            ) as response:
+                if response.status == 200:
+                    html = await response.text()
+                    # selectolax разбирает страницу на C, в разы быстрее html.parser из BeautifulSoup
+                    tree = LexborHTMLParser(html)
                         
-                        results = []
-                        for result in soup.find_all('div', {'class': 'result__body'})[:7]:  # Увеличиваем количество результатов
-                            title_elem = result.find('a', {'class': 'result__a'})
-                            snippet_elem = result.find('a', {'class': 'result__snippet'})
+                    # Добавляем текущую дату для контекста
+                    current_date = today_str()
+                    buf = io.StringIO()
+                    buf.write(f"🔍 РЕЗУЛЬТАТЫ ПОИСКА (на {current_date}):\n\n")
+                    found = 0
+                    for result in tree.css('div.result__body')[:7]:  # Увеличиваем количество результатов
+                        title_elem = result.css_first('a.result__a')
+                        snippet_elem = result.css_first('a.result__snippet')
                             
-                            if title_elem and snippet_elem:
-                                title = title_elem.get_text().strip()
-                                snippet = snippet_elem.get_text().strip()
-                                url = title_elem.get('href', '')
-                                
-                                # Добавляем больше информации из сниппета
-                                results.append(f"• {title}\n{snippet}\n🔗 {url}\n")
+                        if title_elem and snippet_elem:
+                            if found:
+                                buf.write("\n")
+                            # Добавляем больше информации из сниппета
+                            buf.write(f"• {title_elem.text().strip()}\n{snippet_elem.text().strip()}\n🔗 {title_elem.attributes.get('href') or ''}\n")
+                            found += 1
                         
-                        if results:
-                            # Добавляем текущую дату для контекста
-                            current_date = datetime.now().strftime("%d.%m.%Y")
-                            return f"🔍 РЕЗУЛЬТАТЫ ПОИСКА (на {current_date}):\n\n" + "\n".join(results)
+                    if found:
+                        result = SEARCH_CACHE[query] = buf.getvalue()
+                        return result
                         
             return "Не удалось найти информацию по вашему запросу. Пожалуйста, уточните запрос или попробуйте позже."
             
@@ -895,34 +1276,48 @@ class GeminiBot:
     async def search_currency_rates(self, query: str) -> Optional[str]:
         """Поиск курсов валют"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get('https://www.cbr-xml-daily.ru/daily_json.js', timeout=5) as response:
-                    if response.status == 200:
-                        # Обрабатываем ответ как текст, а не как JSON
-                        text_response = await response.text()
-                        # Затем парсим JSON из текста
-                        data = json.loads(text_response)
-                        
-                        # Получаем основные валюты
-                        usd = data['Valute']['USD']
-                        eur = data['Valute']['EUR']
-                        cny = data['Valute']['CNY']
-                        
-                        # Форматируем результат
-                        current_date = datetime.now().strftime("%d.%m.%Y")
-                        result = f"💰 КУРСЫ ВАЛЮТ ЦБ РФ на {current_date}:\n\n"
-                        result += f"🇺🇸 Доллар США (USD): {usd['Value']:.2f} ₽ ({usd['Previous']:.2f} ₽ вчера)\n"
-                        result += f"🇪🇺 Евро (EUR): {eur['Value']:.2f} ₽ ({eur['Previous']:.2f} ₽ вчера)\n"
-                        result += f"🇨🇳 Юань (CNY): {cny['Value']:.2f} ₽ ({cny['Previous']:.2f} ₽ вчера)\n"
-                        
-                        return result
+            valutes = await self.get_cbr_rates()
+            if valutes is None:
+                return "Не удалось получить информацию о курсах валют."
+            
+            # Получаем основные валюты
+            usd = valutes['USD']
+            eur = valutes['EUR']
+            cny = valutes['CNY']
+            
+            # Форматируем результат
+            current_date = today_str()
+            result = f"💰 КУРСЫ ВАЛЮТ ЦБ РФ на {current_date}:\n\n"
+            result += f"🇺🇸 Доллар США (USD): {usd['Value']:.2f} ₽ ({usd['Previous']:.2f} ₽ вчера)\n"
+            result += f"🇪🇺 Евро (EUR): {eur['Value']:.2f} ₽ ({eur['Previous']:.2f} ₽ вчера)\n"
+            result += f"🇨🇳 Юань (CNY): {cny['Value']:.2f} ₽ ({cny['Previous']:.2f} ₽ вчера)\n"
             
-            return "Не удалось получить информацию о курсах валют."
+            return result
             
         except Exception as e:
             logger.error(f"Currency search error: {e}")
             return "Произошла ошибка при получении курсов валют."
 
+    async def get_cbr_rates(self) -> Optional[dict]:
+        """Курсы валют ЦБ РФ с кэшированием на час"""
+        valutes = CURRENCY_CACHE.get('Valute')
+        if valutes is not None:
+            return valutes
+        
+        async with currency_lock:
+            # Пока ждали блокировку, курсы мог загрузить другой запрос
+            valutes = CURRENCY_CACHE.get('Valute')
+            if valutes is not None:
+                return valutes
+            
+            session = get_http_session()
+            async with session.get('https://www.cbr-xml-daily.ru/daily_json.js', timeout=5) as response:
+                if response.status != 200:
+                    return None
+                # Сервер отдает JSON с типом application/javascript - разбираем тело напрямую
+                valutes = CURRENCY_CACHE['Valute'] = orjson.loads(await response.read())['Valute']
+                return valutes
+
     async def search_weather_data(self, query: str) -> Optional[str]:
         """Поиск погоды"""
         return await self.search_duckduckgo(f"погода {query}")
@@ -930,24 +1325,10 @@ class GeminiBot:
     async def get_current_datetime(self, query: str) -> str:
         """Получение текущей даты и времени"""
         try:
-            from datetime import datetime
-            import locale
-            
-            # Пытаемся установить русскую локаль
-            try:
-                locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
-            except:
-                pass
-            
             now = datetime.now()
             
-            # Дни недели и месяцы на русском
-            days_ru = ['понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье']
-            months_ru = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 
-                         'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря']
-            
-            day_of_week = days_ru[now.weekday()]
-            month_name = months_ru[now.month - 1]
+            day_of_week = WEEKDAY_NAMES[now.weekday()]
+            month_name = MONTH_NAMES_GENITIVE[now.month - 1]
             
             date_str = f"{now.day} {month_name} {now.year} года"
             time_str = now.strftime("%H:%M:%S")
@@ -972,21 +1353,41 @@ class GeminiBot:
     async def handle_age_query(self, query: str) -> Optional[str]:
         """Обработка запросов о возрасте с актуальной датой"""
         try:
-            current_date = datetime.now().strftime("%d.%m.%Y")
-            current_year = datetime.now().year
-            
-            # Создаем промпт с актуальной датой
-            age_prompt = f"""ВАЖНАЯ ИНФОРМАЦИЯ: Сегодня {current_date} ({current_year} год).
-            
-Пользователь спрашивает: {query}
-
-При расчете возраста используй ТОЛЬКО текущий {current_year} год. 
-Например, если человек родился в 1971 году, то в {current_year} году ему {current_year - 1971} лет.
+            now = datetime.now()
+            current_year = now.year
+
+            # Если в запросе есть год, возраст считается локально без обращения к Gemini.
+            # Про день рождения говорим, только если год явно назван годом рождения
+            birth_match = BIRTH_YEAR_PATTERN.search(query)
+            if birth_match:
+                birth_year = int(birth_match.group(1) or birth_match.group(2))
+                if birth_year <= current_year:
+                    age = current_year - birth_year
+                    return (
+                        f"Сегодня {format_day(now.date())} ({current_year} год). "
+                        f"Родившемуся в {birth_year} году в {current_year} году исполняется {age} "
+                        f"(до дня рождения - {max(age - 1, 0)})."
+                    )
+
+            year_match = YEAR_PATTERN.search(query)
+            if year_match and int(year_match.group()) <= current_year:
+                year = int(year_match.group())
+                years = current_year - year
+                return (
+                    f"Сегодня {format_day(now.date())} ({current_year} год). "
+                    f"С {year} года прошло {years} {years_word(years)}."
+                )
 
-Отвечай точно и кратко, указывая текущий возраст на {current_year} год."""
+            # Создаем промпт с актуальной датой
+            age_prompt = AGE_PROMPT_TEMPLATE.format(
+                date=format_day(now.date()),
+                year=current_year,
+                example_age=current_year - 1971,
+                query=query
+            )
 
             # Отправляем в Gemini с актуальной датой
-            messages = [{"role": "user", "content": age_prompt}]
+            messages = [age_prompt]
             response = await self.call_gemini_api(messages)
             
             if response:
@@ -998,6 +1399,28 @@ class GeminiBot:
             logger.error(f"Age query error: {e}")
             return "Ошибка при обработке запроса о возрасте."
 
+    def iter_message_chunks(self, text: str, limit: int) -> Iterator[str]:
+        """Разбивка текста на части не длиннее limit за один проход.
+
+        Разрез делается по последнему переводу строки, концу предложения или
+        пробелу в пределах лимита, слова и ссылки не разрываются.
+        """
+        start = 0
+        while len(text) - start > limit:
+            end = start + limit
+            for separator in ('\n', '. ', ' '):
+                cut = text.rfind(separator, start, end)
+                if cut > start:
+                    end = cut + len(separator)
+                    break
+            chunk = text[start:end].strip()
+            if chunk:
+                yield chunk
+            start = end
+        tail = text[start:].strip()
+        if tail:
+            yield tail
+
     async def safe_send_message(self, update: Update, response: str):
         """Безопасная отправка сообщений с учетом лимитов Telegram"""
         max_length = 4096  # Максимальный лимит Telegram для текстовых сообщений
@@ -1005,45 +1428,17 @@ class GeminiBot:
         if len(response) <= max_length:
             # Короткое сообщение - отправляем целиком
             await update.message.reply_text(response)
-        else:
-            # Длинное сообщение - разбиваем на части
-            parts = []
-            current_part = ""
-            
-            # Разбиваем по предложениям
-            sentences = re.split(r'(?<=[.!?])\s+', response)
-            
-            for sentence in sentences:
-                # Если добавление предложения не превышает лимит
-                if len(current_part + sentence) <= max_length:
-                    current_part += sentence + " "
-                else:
-                    # Сохраняем текущую часть и начинаем новую
-                    if current_part:
-                        parts.append(current_part.strip())
-                    
-                    # Если само предложение очень длинное - принудительно разбиваем
-                    if len(sentence) > max_length:
-                        for i in range(0, len(sentence), max_length):
-                            parts.append(sentence[i:i + max_length])
-                        current_part = ""
-                    else:
-                        current_part = sentence + " "
-            
-            # Добавляем последнюю часть
-            if current_part:
-                parts.append(current_part.strip())
-            
-            # Отправляем части
-            for i, part in enumerate(parts):
-                if i == 0:
-                    await update.message.reply_text(part)
-                else:
-                    await update.message.reply_text(f"(продолжение {i+1}/{len(parts)})\n\n{part}")
-                
-                # Небольшая задержка между сообщениями
-                if i < len(parts) - 1:
-                    await asyncio.sleep(0.5)
+            return
+        
+        # Длинное сообщение - разбиваем на части с запасом под заголовок "(продолжение i/N)"
+        parts = list(self.iter_message_chunks(response, max_length - 32))
+        
+        # Части отправляются последовательно, чтобы сохранить порядок в чате;
+        # паузы не нужны - темп отправки соблюдает AIORateLimiter
+        reply_text = update.message.reply_text
+        await reply_text(parts[0])
+        for i, part in enumerate(parts[1:], 2):
+            await reply_text(f"(продолжение {i}/{len(parts)})\n\n{part}")
 
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка изображений"""
@@ -1053,11 +1448,7 @@ class GeminiBot:
         
         if not self.can_make_request(user_id):
             remaining_minute, remaining_day = self.get_remaining_requests(user_id)
-            await update.message.reply_text(
-                f"⚠️ Превышен лимит запросов.\n"
-                f"🕐 Осталось в минуте: {remaining_minute}\n"
-                f"📅 Осталось сегодня: {remaining_day}"
-            )
+            await update.message.reply_text(LIMIT_EXCEEDED_TEMPLATE % (remaining_minute, remaining_day))
             return
             
         self.add_request(user_id)
@@ -1067,53 +1458,42 @@ class GeminiBot:
             photo = update.message.photo[-1]
             file = await context.bot.get_file(photo.file_id)
             
-            # Скачиваем изображение
-            async with aiohttp.ClientSession() as session:
-                async with session.get(file.file_path) as response:
-                    if response.status == 200:
-                        image_data = await response.read()
-                        
-                        # Кодируем в base64
-                        image_base64 = base64.b64encode(image_data).decode('utf-8')
-                        
-                        # Отправляем в Gemini
-                        headers = {'Content-Type': 'application/json'}
-                        data = {
-                            "contents": [
-                                {
-                                    "parts": [
-                                        {"text": "Опиши что ты видишь на этом изображении подробно."},
-                                        {
-                                            "inline_data": {
-                                                "mime_type": "image/jpeg",
-                                                "data": image_base64
-                                            }
-                                        }
-                                    ]
-                                }
-                            ]
-                        }
-                        
-                        async with session.post(
-                            f"{GEMINI_API_URL}?key={AI_API_KEY}",
-                            headers=headers,
-                            json=data,
-                            timeout=30
-                        ) as api_response:
-                            if api_response.status == 200:
-                                result = await api_response.json()
-                                if 'candidates' in result and len(result['candidates']) > 0:
-                                    response = result['candidates'][0]['content']['parts'][0]['text']
-                                    await self.safe_send_message(update, response)
-                                else:
-                                    await update.message.reply_text("Не удалось обработать изображение.")
-                            else:
-                                await update.message.reply_text("Ошибка при анализе изображения.")
-                    else:
-                        await update.message.reply_text("Не удалось скачать изображение.")
+            # Скачиваем изображение частями в один буфер
+            session = get_http_session()
+            async with session.get(file.file_path) as response:
+                if response.status != 200:
+                    await update.message.reply_text("Не удалось скачать изображение.")
+                    return
+                image_data = bytearray()
+                async for chunk in response.content.iter_chunked(1 << 16):
+                    image_data += chunk
+            
+            # Кодирование в base64 и сериализация тела (несколько МБ) выполняются в пуле потоков,
+            # чтобы большие фото не блокировали event loop
+            body = await asyncio.to_thread(build_image_request_body, image_data)
+            del image_data
+            
+            # Запрос идет через общий HTTP/2-клиент Gemini
+            async with gemini_semaphore:
+                api_response = await get_gemini_client().post(
+                    GEMINI_URL_WITH_KEY,
+                    headers=GEMINI_HEADERS,
+                    content=body
+                )
+            del body
+            
+            if api_response.status_code == 200:
+                result = orjson.loads(api_response.content)
+                if 'candidates' in result and len(result['candidates']) > 0:
+                    response = result['candidates'][0]['content']['parts'][0]['text']
+                    await self.safe_send_message(update, response)
+                else:
+                    await update.message.reply_text("Не удалось обработать изображение.")
+            else:
+                await update.message.reply_text("Ошибка при анализе изображения.")
                         
         except Exception as e:
-            logger.error(f"Error processing photo: {e}")
+            logger.error("Error processing photo: %s", e)
             await update.message.reply_text("Произошла ошибка при обработке изображения.")
 
     async def handle_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1123,73 +1503,62 @@ class GeminiBot:
         
         # Проверка дублирования
         if message_id in processed_messages:
-            logger.info(f"Message {message_id} already processed, skipping")
+            processed_messages.move_to_end(message_id)
+            logger.info("Message %s already processed, skipping", message_id)
             return
         
-        # Отмечаем сообщение как обрабатываемое
-        processed_messages[message_id] = True
+        # Отмечаем сообщение как обрабатываемое, вытесняя самые старые записи
+        processed_messages[message_id] = None
+        while len(processed_messages) > PROCESSED_MESSAGES_LIMIT:
+            processed_messages.popitem(last=False)
         
-        logger.info(f"Received voice message from user {user_id}")
+        logger.info("Received voice message from user %s", user_id)
         
         if not VOICE_FEATURES_AVAILABLE:
-            await update.message.reply_text(
-                "🎤 Извините, голосовые функции недоступны.\n\n"
-                "Сервер не поддерживает обработку голосовых сообщений.\n"
-                "Пожалуйста, отправьте ваш вопрос текстом."
-            )
+            await update.message.reply_text(VOICE_UNAVAILABLE_MESSAGE)
             return
         
+        typing_task: Optional[asyncio.Task] = None
         try:
             # Проверка лимитов
             if not self.can_make_request(user_id):
                 remaining_minute, remaining_day = self.get_remaining_requests(user_id)
                 await update.message.reply_text(
-                    f"❌ Превышен лимит запросов!\n\n"
-                    f"Осталось запросов: {remaining_minute}/{MINUTE_LIMIT} в этой минуте, {remaining_day}/{DAILY_LIMIT} сегодня."
+                    VOICE_LIMIT_EXCEEDED_TEMPLATE % (remaining_minute, MINUTE_LIMIT, remaining_day, DAILY_LIMIT)
                 )
                 return
 
-            # Отправка индикатора печати
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-            logger.info(f"Sent typing indicator for voice processing from user {user_id}")
+            # Индикатор печати обновляется в фоне, пока готовится ответ
+            typing_task = asyncio.create_task(self.keep_chat_action(context, update.effective_chat.id))
             
             # Получение голосового файла
             voice_file = await update.message.voice.get_file()
             voice_bytes = await voice_file.download_as_bytearray()
             
-            logger.info(f"Downloaded voice message: {len(voice_bytes)} bytes")
+            logger.info("Downloaded voice message: %d bytes", len(voice_bytes))
             
-            # Распознавание речи - отправляем служебное сообщение
-            await self.send_service_message(update, context, "🎤 Распознаю речь...", user_id)
+            # Распознавание речи - служебное сообщение отправляется параллельно с работой
+            self.post_service_message(update, context, "🎤 Распознаю речь...", user_id)
             
             transcribed_text = await self.speech_to_text(bytes(voice_bytes))
             
             if not transcribed_text:
                 await self.cleanup_service_messages(update, context, user_id)
-                await update.message.reply_text(
-                    "❌ Не удалось распознать речь.\n\n"
-                    "Попробуйте:\n"
-                    "• Говорить четче и громче\n"
-                    "• Уменьшить фоновый шум\n"
-                    "• Записать сообщение заново"
-                )
+                await update.message.reply_text(SPEECH_NOT_RECOGNIZED_MESSAGE)
                 return
             
-            logger.info(f"Voice transcribed for user {user_id}: {transcribed_text[:50]}...")
+            logger.info("Voice transcribed for user %s: %.50s...", user_id, transcribed_text)
             
             # Отправляем подтверждение распознавания - заменяем предыдущее служебное сообщение
-            await self.send_service_message(update, context, f"✅ Распознано: \"{transcribed_text}\"", user_id)
+            self.post_service_message(update, context, f"✅ Распознано: \"{transcribed_text}\"", user_id)
             
             # Проверка, нужны ли актуальные данные
             needs_current = self.needs_current_data(transcribed_text)
             if needs_current:
-                logger.info(f"Voice user {user_id} needs current data for: {transcribed_text}")
-                
-                # Удаляем предыдущее служебное сообщение
-                await self.cleanup_service_messages(update, context, user_id)
+                logger.info("Voice user %s needs current data for: %s", user_id, transcribed_text)
                 
-                # Отправляем новое служебное сообщение
-                await self.send_service_message(update, context, "🔍 Ищу актуальную информацию...", user_id)
+                # Заменяем служебное сообщение, не дожидаясь отправки
+                self.post_service_message(update, context, "🔍 Ищу актуальную информацию...", user_id)
                 
                 # Получаем актуальные данные
                 current_data = await self.get_current_data(transcribed_text)
@@ -1199,17 +1568,20 @@ class GeminiBot:
                     transcribed_text = f"{transcribed_text}\n\nАктуальная информация: {current_data}"
             
             # Добавление сообщения пользователя в историю
-            user_sessions[user_id].append({"role": "user", "content": transcribed_text})
-            messages = list(user_sessions[user_id])
+            user_sessions[user_id].append(transcribed_text)
+            user_last_seen[user_id] = time.monotonic()
 
             # Уведомление о начале обработки - заменяем предыдущее служебное сообщение
-            await self.send_service_message(update, context, "💭 Думаю над ответом...", user_id)
+            self.post_service_message(update, context, "💭 Думаю над ответом...", user_id)
             
-            logger.info(f"Calling Gemini API for voice message from user {user_id}")
-            response = await self.call_gemini_api(messages)
+            logger.info("Calling Gemini API for voice message from user %s", user_id)
+            try:
+                response = await self.call_gemini_api(user_sessions[user_id])
+            finally:
+                typing_task.cancel()
             
             if response:
-                logger.info(f"Received response from Gemini API for voice message from user {user_id}: {len(response)} characters")
+                logger.info("Received response from Gemini API for voice message from user %s: %d characters", user_id, len(response))
                 
                 # Добавление запроса в счетчик
                 self.add_request(user_id)
@@ -1218,59 +1590,113 @@ class GeminiBot:
                 selected_engine = voice_engine_settings.get(user_id, DEFAULT_VOICE_ENGINE)
                 if VOICE_ENGINES[selected_engine]["available"]:
                     # Генерация голосового ответа - заменяем предыдущее служебное сообщение
-                    await self.send_service_message(update, context, "🎵 Генерирую голосовой ответ...", user_id)
+                    self.post_service_message(update, context, "🎵 Генерирую голосовой ответ...", user_id)
                     
-                    # Очистка текста от markdown символов для лучшего озвучивания
-                    clean_response = self.clean_text_for_speech(response)
-                    
-                    # ДЛЯ ГОЛОСОВЫХ СООБЩЕНИЙ: весь ответ в одном файле, без разделения
-                    logger.info(f"Synthesizing complete voice response: {len(clean_response)} characters")
-                    voice_data = await self.text_to_speech(clean_response, user_id)
-                    
-                    if voice_data:
-                        await self.cleanup_service_messages(update, context, user_id)
-                        # Отправляем голосовой ответ без информации о лимитах
-                        await update.message.reply_voice(
-                            voice=BytesIO(voice_data),
-                            caption="🎤 Голосовой ответ"
-                        )
-                        logger.info(f"Successfully sent complete voice response to user {user_id}")
-                        user_sessions[user_id].append({"role": "assistant", "content": response})
+                    # ДЛЯ ГОЛОСОВЫХ СООБЩЕНИЙ: весь ответ в одном файле, без разделения.
+                    # Очистка от markdown и синтез частей идут потоково, части склеиваются в один файл
+                    logger.info("Synthesizing complete voice response: %d characters", len(response))
+                    if await self.send_voice_reply(update, context, response, user_id):
+                        logger.info("Successfully sent complete voice response to user %s", user_id)
+                        user_sessions[user_id].append(response)
                     else:
                         # Fallback к тексту
                         await self.cleanup_service_messages(update, context, user_id)
                         await update.message.reply_text(
                             f"💬 {response}\n\n⚠️ Не удалось создать голосовой ответ"
                         )
-                        user_sessions[user_id].append({"role": "assistant", "content": response})
+                        user_sessions[user_id].append(response)
                 else:
                     # Текстовый ответ
                     await self.cleanup_service_messages(update, context, user_id)
                     await update.message.reply_text(f"💬 {response}")
                     
                     # Добавление ответа в историю
-                    user_sessions[user_id].append({"role": "assistant", "content": response})
+                    user_sessions[user_id].append(response)
             else:
                 await self.cleanup_service_messages(update, context, user_id)
-                await update.message.reply_text(
-                    "❌ Не удалось получить ответ от ИИ.\n\n"
-                    "Попробуйте:\n"
-                    "• Переформулировать вопрос\n"
-                    "• Повторить запрос через несколько секунд\n"
-                    "• Проверить соединение с интернетом"
-                )
+                await update.message.reply_text(AI_NO_RESPONSE_MESSAGE)
                 
         except Exception as e:
-            logger.error(f"Error processing voice message: {e}")
+            logger.error("Error processing voice message: %s", e)
             await self.cleanup_service_messages(update, context, user_id)
-            await update.message.reply_text("❌ Произошла ошибка при обработке голосового сообщения.")
-        
+            await update.message.reply_text(VOICE_ERROR_MESSAGE)
+        finally:
+            if typing_task:
+                typing_task.cancel()
+
+    async def send_voice_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int) -> bool:
+        """Отправка голосового ответа одним файлом.
+
+        Части синтезируются потоково, а затем склеиваются: MP3 - поток независимых
+        фреймов, так же gTTS собирает длинный текст. Если часть не синтезировалась
+        и после повтора, весь ответ озвучивается одним вызовом gTTS, чтобы не смешивать
+        движки в одном файле. Возвращает False, если голос создать не удалось.
+        """
+        voice_parts = self.text_to_speech_stream(text, user_id)
+        voice_data = []
+        try:
+            async for part in voice_parts:
+                if not part:
+                    voice_data = None
+                    break
+                voice_data.append(part)
         finally:
-            # Очистка старых записей обработанных сообщений (оставляем только последние 100)
-            if len(processed_messages) > 100:
-                old_keys = list(processed_messages.keys())[:-50]  # Удаляем старые, оставляем 50 новых
-                for key in old_keys:
-                    processed_messages.pop(key, None)
+            # Закрытие генератора отменяет синтез частей, которые уже не понадобятся
+            await voice_parts.aclose()
+
+        if voice_data:
+            voice = b''.join(voice_data)
+        else:
+            logger.warning("Voice part synthesis failed for user %s, synthesizing the whole reply with gTTS", user_id)
+            voice = await self._gtts_synthesize(self.clean_text_for_speech(text), "ru")
+            if not voice:
+                return False
+
+        # Удаляем служебные сообщения перед ответом
+        await self.cleanup_service_messages(update, context, user_id)
+
+        try:
+            await update.message.reply_voice(voice=voice, caption="🎤 Голосовой ответ")
+        except RetryAfter as e:
+            # Пауза только при срабатывании flood-контроля Telegram
+            logger.warning("Flood control on voice reply for user %s, retrying in %ss", user_id, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+            await update.message.reply_voice(voice=voice, caption="🎤 Голосовой ответ")
+        return True
+
+    async def keep_chat_action(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, action: str = "typing"):
+        """Поддерживает индикатор действия в чате, пока задачу не отменят.
+
+        Telegram показывает индикатор около 5 секунд, поэтому он обновляется каждые 4.
+        """
+        while True:
+            try:
+                await context.bot.send_chat_action(chat_id=chat_id, action=action)
+            except Exception as e:
+                logger.debug(f"Could not send chat action to {chat_id}: {e}")
+            await asyncio.sleep(4)
+
+    def post_service_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int):
+        """Заменяет служебное сообщение в фоне, не задерживая обработку.
+
+        Замены выполняются строго по очереди, а cleanup_service_messages
+        дожидается последней, поэтому служебные сообщения не теряются.
+        """
+        previous = pending_service_messages.get(user_id)
+
+        async def replace():
+            if previous:
+                await previous
+            await self.send_service_message(update, context, text, user_id)
+
+        task = asyncio.create_task(replace())
+        pending_service_messages[user_id] = task
+
+        def forget(finished: asyncio.Task):
+            if pending_service_messages.get(user_id) is finished:
+                del pending_service_messages[user_id]
+
+        task.add_done_callback(forget)
 
     async def add_service_message(self, user_id: int, message_id: int):
         """Добавление служебного сообщения для отслеживания"""
@@ -1278,24 +1704,54 @@ class GeminiBot:
 
     async def cleanup_service_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
         """Удаляет все накопленные служебные сообщения пользователя"""
+        # Сначала дожидаемся служебных сообщений, которые еще отправляются в фоне
+        pending = pending_service_messages.get(user_id)
+        if pending:
+            await asyncio.wait((pending,))
+        await self.delete_service_messages(update, context, user_id)
+
+    async def delete_service_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+        """Удаляет уже отправленные служебные сообщения пользователя"""
         try:
-            for message_id in user_service_messages[user_id]:
-                try:
-                    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=message_id)
-                except Exception as e:
-                    logger.debug(f"Could not delete service message {message_id}: {e}")
+            # Забираем список до удаления, чтобы параллельные обработчики не удалили сообщения повторно;
+            # запись пользователя удаляется целиком, чтобы словарь не рос с каждым новым пользователем
+            message_ids = user_service_messages.pop(user_id, None)
+            if not message_ids:
+                return
+
+            # Удаляем все сообщения параллельно
+            chat_id = update.effective_chat.id
+            delete_message = context.bot.delete_message
+            results = await asyncio.gather(
+                *(delete_message(chat_id=chat_id, message_id=message_id) for message_id in message_ids),
+                return_exceptions=True
+            )
+            for message_id, result in zip(message_ids, results):
+                if isinstance(result, Exception):
+                    logger.debug(f"Could not delete service message {message_id}: {result}")
             
-            # Очищаем список после удаления
-            user_service_messages[user_id].clear()
             logger.debug(f"Cleaned up service messages for user {user_id}")
         except Exception as e:
             logger.error(f"Error cleaning up service messages for user {user_id}: {e}")
             
     async def send_service_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_id: int) -> Optional[int]:
-        """Отправляет служебное сообщение и добавляет его в список для автоудаления"""
+        """Показывает служебное сообщение и добавляет его в список для автоудаления
+
+        Если служебное сообщение уже есть, его текст заменяется одним вызовом
+        edit_message_text вместо удаления и отправки нового.
+        """
         try:
-            # Сначала удаляем предыдущие служебные сообщения
-            await self.cleanup_service_messages(update, context, user_id)
+            message_ids = user_service_messages.get(user_id)
+            if message_ids:
+                message_id = message_ids[-1]
+                try:
+                    await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=message_id, text=text)
+                    return message_id
+                except Exception as e:
+                    logger.debug(f"Could not edit service message {message_id}: {e}")
+            
+            # Удаляем предыдущие служебные сообщения
+            await self.delete_service_messages(update, context, user_id)
             
             # Отправляем новое служебное сообщение
             message = await update.message.reply_text(text)
@@ -1316,10 +1772,7 @@ class GeminiBot:
         remaining_minute, remaining_day = self.get_remaining_requests(user_id)
         
         await update.message.reply_text(
-            f"📊 *Информация о лимитах запросов*\n\n"
-            f"• Осталось в текущей минуте: {remaining_minute}/{MINUTE_LIMIT}\n"
-            f"• Осталось сегодня: {remaining_day}/{DAILY_LIMIT}\n\n"
-            f"_Лимиты нужны для защиты от перегрузки и обеспечения стабильной работы бота._",
+            LIMITS_MESSAGE_TEMPLATE % (remaining_minute, remaining_day),
             parse_mode=ParseMode.MARKDOWN
         )
 
@@ -1333,6 +1786,13 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 # HTTP сервер и webhook
+async def process_update_in_background(update: Update):
+    """Обработка обновления вне webhook-запроса с логированием ошибок"""
+    try:
+        await telegram_app.process_update(update)
+    except Exception as e:
+        logger.error(f"Error processing update {update.update_id}: {e}", exc_info=True)
+
 async def health_check(request):
     """Health check endpoint"""
     return web.Response(text="Bot is running! Status: Active")
@@ -1340,19 +1800,25 @@ async def health_check(request):
 async def webhook_handler(request):
     """Обработчик webhook"""
     try:
-        logger.info(f"Webhook received: {request.method} {request.path}")
-        data = await request.json()
-        logger.info(f"Webhook data keys: {list(data.keys())}")
+        logger.debug("Webhook received: %s %s", request.method, request.path)
+        data = orjson.loads(await request.read())
+        logger.debug("Webhook data keys: %s", data.keys())
         
         if not telegram_app:
             logger.error("telegram_app is None!")
             return web.Response(status=500, text="Bot not initialized")
+        
+        # Все обработчики бота работают с update.message: остальные типы обновлений
+        # (edited_message, channel_post и т.д.) отбрасываем, не собирая объекты Telegram
+        if "message" not in data:
+            logger.debug("Skipping update without message: %s", data.get('update_id'))
+            return web.Response(status=200, text="OK")
             
         update = Update.de_json(data, telegram_app.bot)
-        logger.info(f"Update processed: {update.update_id if update else 'None'}")
+        logger.info("Update processed: %s", update.update_id if update else None)
         
-        # ДОБАВЛЕНО: Детальное логирование для команд
-        if update and update.message and update.message.text:
+        # Детальное логирование для команд (только при DEBUG_WEBHOOK=1)
+        if DEBUG_WEBHOOK and update and update.message and update.message.text:
             message_text = update.message.text
             logger.info(f"Message text: '{message_text}'")
             
@@ -1370,10 +1836,14 @@ async def webhook_handler(request):
                         elif hasattr(handler, 'command') and handler.command == message_text[1:]:
                             logger.info(f"Found handler for command: {message_text}")
         
-        await telegram_app.process_update(update)
+        # Сразу отвечаем Telegram, а обновление обрабатываем в фоне,
+        # чтобы долгие ответы (Gemini, синтез речи) не задерживали доставку
+        task = asyncio.create_task(process_update_in_background(update))
+        webhook_tasks.add(task)
+        task.add_done_callback(webhook_tasks.discard)
         return web.Response(status=200, text="OK")
     except Exception as e:
-        logger.error(f"Webhook error: {e}", exc_info=True)
+        logger.error("Webhook error: %s", e, exc_info=True)
         return web.Response(status=500, text=f"Error: {str(e)}")
 
 async def start_web_server():
@@ -1383,7 +1853,8 @@ async def start_web_server():
     app.router.add_get('/health', health_check)
     app.router.add_post('/webhook', webhook_handler)
     
-    runner = web.AppRunner(app)
+    # Access log не нужен: каждое обновление и так логируется в webhook_handler
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
@@ -1405,17 +1876,46 @@ async def keep_alive():
             await asyncio.sleep(300)  # 300 секунд = 5 минут
             
             # Пингуем health endpoint
-            async with aiohttp.ClientSession() as session:
-                async with session.get(health_url, timeout=10) as response:
-                    if response.status == 200:
-                        logger.info(f"Keep-alive ping successful: {response.status}")
-                    else:
-                        logger.warning(f"Keep-alive ping returned status: {response.status}")
+            session = get_http_session()
+            async with session.get(health_url, timeout=10) as response:
+                if response.status == 200:
+                    logger.info(f"Keep-alive ping successful: {response.status}")
+                else:
+                    logger.warning(f"Keep-alive ping returned status: {response.status}")
         except Exception as e:
             logger.error(f"Keep-alive ping error: {e}")
             # Продолжаем работу даже при ошибке
             pass
 
+async def warm_up_connections():
+    """Заранее открывает соединения к Gemini и Azure TTS, чтобы первый запрос пользователя
+    не тратил время на DNS, TCP и TLS (дальше соединения держат общие клиенты)"""
+    try:
+        await get_gemini_client().head(GEMINI_API_URL)
+    except Exception as e:
+        logger.warning(f"Gemini warm-up failed: {e}")
+    
+    if AZURE_SPEECH_KEY:
+        try:
+            async with get_http_session().head(AZURE_TTS_URL, timeout=10):
+                pass
+        except Exception as e:
+            logger.warning(f"Azure TTS warm-up failed: {e}")
+
+async def cleanup_idle_sessions():
+    """Фоновая задача: удаление истории чата пользователей, неактивных дольше SESSION_IDLE_TIMEOUT"""
+    while True:
+        await asyncio.sleep(600)  # Проверяем раз в 10 минут
+
+        deadline = time.monotonic() - SESSION_IDLE_TIMEOUT
+        idle_users = [user_id for user_id, last_seen in user_last_seen.items() if last_seen < deadline]
+        for user_id in idle_users:
+            user_last_seen.pop(user_id, None)
+            user_sessions.pop(user_id, None)
+
+        if idle_users:
+            logger.info(f"Dropped chat history of {len(idle_users)} idle users")
+
 async def main():
     """Основная функция"""
     global telegram_app
@@ -1424,7 +1924,7 @@ async def main():
     logger.info(f"TELEGRAM_TOKEN: {'✓' if TELEGRAM_TOKEN else '✗'}")
     logger.info(f"AI_API_KEY: {'✓' if AI_API_KEY else '✗'}")
     logger.info(f"NEWS_API_KEY: {'✓' if NEWS_API_KEY else '✗'}")
-    logger.info(f"AZURE_SPEECH_KEY: {'✓' if os.getenv('AZURE_SPEECH_KEY') else '✗'}")
+    logger.info(f"AZURE_SPEECH_KEY: {'✓' if AZURE_SPEECH_KEY else '✗'}")
     logger.info(f"PORT: {PORT}")
     logger.info(f"RENDER environment: {'✓' if os.environ.get('RENDER') else '✗'}")
     
@@ -1432,44 +1932,33 @@ async def main():
         logger.error("Missing required environment variables")
         return
         
+    # Пул потоков для блокирующих операций (распознавание и синтез речи, NewsAPI)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=8))
+    
     # Инициализируем голосовые движки
     initialize_voice_engines()
     logger.info("Voice engines initialized")
     
     # Создание приложения
-    telegram_app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # AIORateLimiter соблюдает лимиты Telegram на отправку (30 сообщений/с, 20 в минуту на группу)
+    telegram_app = Application.builder().token(TELEGRAM_TOKEN).rate_limiter(AIORateLimiter()).build()
     bot = GeminiBot()
     
     # Добавление обработчиков
+    # Внутри группы PTB останавливается на первом подходящем обработчике, поэтому самые
+    # частые обновления (текст, голос, фото) идут первыми; их фильтры не пересекаются с командами
+    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
+    telegram_app.add_handler(MessageHandler(filters.VOICE, bot.handle_voice))
+    telegram_app.add_handler(MessageHandler(filters.PHOTO, bot.handle_photo))
+
     telegram_app.add_handler(CommandHandler("start", bot.start_command))
     telegram_app.add_handler(CommandHandler("help", bot.help_command))
     telegram_app.add_handler(CommandHandler("clear", bot.clear_command))
     telegram_app.add_handler(CommandHandler("limits", bot.show_limits))
     telegram_app.add_handler(CommandHandler("voice", bot.voice_command))
     telegram_app.add_handler(CommandHandler("voice_select", bot.voice_select_command))
-    # Голосовые команды - используем отдельные методы вместо лямбда
-    async def voice_gtts_command(u, c): await bot.set_voice_engine_command(u, c, "gtts")
-    # Azure Speech Services команды
-    async def voice_dmitri_command(u, c): await bot.set_voice_engine_command(u, c, "azure_dmitri")
-    async def voice_svetlana_command(u, c): await bot.set_voice_engine_command(u, c, "azure_svetlana")
-    
-    # ДОБАВЛЯЕМ ОБРАБОТЧИКИ ДЛЯ КОМАНД С ПОДЧЕРКИВАНИЕМ И БЕЗ
-    # Google TTS
-    telegram_app.add_handler(CommandHandler("voice_gtts", voice_gtts_command))
-    telegram_app.add_handler(CommandHandler("voicegtts", voice_gtts_command))  # БЕЗ подчеркивания
-    
-    # Azure Speech Services голоса
-    # Мужские голоса
-    telegram_app.add_handler(CommandHandler("voice_dmitri", voice_dmitri_command))
-    telegram_app.add_handler(CommandHandler("voicedmitri", voice_dmitri_command))  # БЕЗ подчеркивания
-    
-    # Женские голоса
-    telegram_app.add_handler(CommandHandler("voice_svetlana", voice_svetlana_command))
-    telegram_app.add_handler(CommandHandler("voicesvetlana", voice_svetlana_command))  # БЕЗ подчеркивания
-
-    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
-    telegram_app.add_handler(MessageHandler(filters.PHOTO, bot.handle_photo))
-    telegram_app.add_handler(MessageHandler(filters.VOICE, bot.handle_voice))
+    # Все команды выбора голоса (с подчеркиванием и без) - один обработчик
+    telegram_app.add_handler(MessageHandler(filters.Regex(VOICE_COMMAND_PATTERN), bot.voice_engine_command))
     telegram_app.add_error_handler(error_handler)
     
     # Определяем окружение
@@ -1479,13 +1968,6 @@ async def main():
     await telegram_app.initialize()
     await telegram_app.start()
     
-    # Очистка webhook
-    try:
-        await telegram_app.bot.delete_webhook(drop_pending_updates=True)
-        await asyncio.sleep(1)
-    except Exception as e:
-        logger.error(f"Error clearing webhook: {e}")
-    
     # Запуск веб сервера
     web_server = await start_web_server()
     
@@ -1493,31 +1975,59 @@ async def main():
     if is_production:
         # Webhook для продакшена
         webhook_url = "https://google-gemini-bot.onrender.com/webhook"
-        logger.info(f"Setting webhook to {webhook_url}")
         
         try:
-            await telegram_app.bot.set_webhook(url=webhook_url)
-            logger.info("Webhook set successfully")
+            # Если webhook уже настроен так же и очередь пуста, повторная установка не нужна
+            info = await telegram_app.bot.get_webhook_info()
+            if (info.url == webhook_url and info.pending_update_count == 0
+                    and info.max_connections == 100 and info.allowed_updates == (Update.MESSAGE,)):
+                logger.info(f"Webhook already set to {webhook_url}")
+            else:
+                logger.info(f"Setting webhook to {webhook_url}")
+                # Telegram доставляет только сообщения (других обработчиков нет) и до 100 обновлений параллельно;
+                # накопившиеся обновления сбрасываются, как раньше делал delete_webhook
+                await telegram_app.bot.set_webhook(
+                    url=webhook_url,
+                    max_connections=100,
+                    allowed_updates=[Update.MESSAGE],
+                    drop_pending_updates=True
+                )
+                logger.info("Webhook set successfully")
             
         except Exception as e:
             logger.error(f"Webhook error: {e}")
             # Fallback к поллингу
-            await telegram_app.updater.start_polling(drop_pending_updates=True)
+            await telegram_app.updater.start_polling(drop_pending_updates=True, allowed_updates=[Update.MESSAGE])
             logger.info("Fallback to polling")
     else:
-        # Поллинг для локальной разработки
+        # Поллинг для локальной разработки (start_polling сам удаляет webhook)
         logger.info("Starting polling mode")
-        await telegram_app.updater.start_polling(drop_pending_updates=True)
+        await telegram_app.updater.start_polling(drop_pending_updates=True, allowed_updates=[Update.MESSAGE])
         logger.info("Polling started")
     
     # Запускаем фоновую задачу для пингования сервера (только в production)
     if is_production:
-        asyncio.create_task(keep_alive())
+        start_background_task(keep_alive())
         logger.info("Keep-alive task started for production environment")
     
+    # Очистка истории неактивных пользователей
+    start_background_task(cleanup_idle_sessions())
+    
+    # Прогрев соединений к внешним API
+    start_background_task(warm_up_connections())
+    
     # Ожидаем бесконечно
-    await asyncio.Event().wait()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await close_http_session()
     return web_server
 
 if __name__ == '__main__':
-    asyncio.run(main()) 
\ No newline at end of file
+    # uvloop (libuv) заметно быстрее стандартного event loop; без него работаем на asyncio
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main()) 
\ No newline at end of file
@@ -5,6 +5,7 @@
 
 import os
 import sys
+import json
 import subprocess
 import urllib.request
 import tarfile
@@ -16,12 +17,21 @@ logger = logging.getLogger(__name__)
 PIPER_VERSION = "1.2.0"
 PIPER_DIR = "piper_tts"
 VOICES_DIR = "piper_voices"
+INSTALL_CACHE = f"{PIPER_DIR}/.installed.json"
 
 def download_file(url, filename):
     """Загрузка файла"""
     logger.info(f"Загрузка {url} -> {filename}")
     urllib.request.urlretrieve(url, filename)
 
+def list_voice_models():
+    """Список файлов голосовых моделей (.onnx) за один проход по директории"""
+    try:
+        with os.scandir(VOICES_DIR) as entries:
+            return sorted(entry.name for entry in entries if entry.name.endswith('.onnx') and entry.is_file())
+    except FileNotFoundError:
+        return []
+
 def setup_piper():
     """Установка Piper TTS"""
     try:
@@ -78,11 +88,12 @@ def setup_piper():
             }
         ]
         
+        installed_models = set(list_voice_models())
         for voice in voices_to_download:
             model_path = f"{VOICES_DIR}/{voice['name']}.onnx"
             config_path = f"{VOICES_DIR}/{voice['name']}.onnx.json"
             
-            if not os.path.exists(model_path):
+            if f"{voice['name']}.onnx" not in installed_models:
                 logger.info(f"Загрузка голоса {voice['name']}...")
                 download_file(voice['url'], model_path)
                 download_file(voice['config_url'], config_path)
@@ -105,7 +116,7 @@ def test_piper():
             return False
             
         # Проверяем доступные голоса
-        voices = [f for f in os.listdir(VOICES_DIR) if f.endswith('.onnx')]
+        voices = list_voice_models()
         if not voices:
             logger.error("Голоса не найдены")
             return False
@@ -130,8 +141,40 @@ def test_piper():
         logger.error(f"Ошибка тестирования Piper TTS: {e}")
         return False
 
+def load_install_cache():
+    """Загрузка сохраненного результата проверки установки.
+
+    Возвращает данные кэша, если исполняемый файл не менялся с момента проверки.
+    """
+    try:
+        with open(INSTALL_CACHE) as f:
+            cached = json.load(f)
+        if os.path.getmtime(cached["path"]) == cached["mtime"]:
+            return cached
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def save_install_cache():
+    """Сохранение результата успешной проверки установки"""
+    piper_path = f"{PIPER_DIR}/piper/piper"
+    try:
+        cached = {
+            "path": piper_path,
+            "mtime": os.path.getmtime(piper_path),
+            "models": list_voice_models()
+        }
+        with open(INSTALL_CACHE, 'w') as f:
+            json.dump(cached, f)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить кэш установки: {e}")
+
 if __name__ == "__main__":
-    if setup_piper():
-        test_piper()
+    cached = load_install_cache()
+    if cached:
+        logger.info(f"Piper TTS уже установлен и проверен, голосов: {len(cached['models'])}")
+    elif setup_piper():
+        if test_piper():
+            save_install_cache()
     else:
         sys.exit(1) 
\ No newline at end of file
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from main import GeminiBot
+
+LONG_SENTENCE = ("Очень длинное предложение " * 8)[:197] + "."  # 198 символов: следующая фраза не помещается
+
+
+@pytest.fixture(scope="module")
+def bot():
+    return GeminiBot()
+
+
+@pytest.mark.parametrize("text", [
+    LONG_SENTENCE + " Ну",
+    "Ну. " + LONG_SENTENCE,
+    LONG_SENTENCE + " 5. " + LONG_SENTENCE,
+    LONG_SENTENCE + " " + LONG_SENTENCE + " Ок.",
+    LONG_SENTENCE + " 🎤!",
+])
+def test_no_chunk_too_short_for_tts(bot, text):
+    chunks = list(bot.iter_speech_chunks(text))
+    assert chunks
+    assert all(len(chunk) >= 3 for chunk in chunks)
+
+
+def test_chunks_keep_all_words(bot):
+    text = LONG_SENTENCE + " Ну"
+    assert " ".join(bot.iter_speech_chunks(text)).split() == bot.clean_text_for_speech(text).split()